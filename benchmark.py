@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+# coding: utf8
+
+# This file measures the time taken by the hot paths of generator.py:
+# imagining the exercices, writing their questions and corrections, the l33t translation,
+# the conversions of compositions of tasks, and the generation of a whole sheet.
+# All the random draws use fixed seeds, so that two runs measure the same work.
+
+import getopt
+import json
+import os
+import platform
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+import generator
+
+SEEDS = range(20)
+LANGS = ("FR", "EN")
+L33T_LEVELS = (0, 1, 2, 3)
+TREE_DEPTHS = (1, 2, 4, 6, 8)
+TREE_SIZES = (4, 8, 16, 32, 64)
+SEQUENCE_LENGTHS = (8, 64, 512, 4096)
+REPEAT = 5
+THRESHOLD = 1.25  # a benchmark slower than THRESHOLD times its baseline is a regression
+
+# A latexmk that does not run LaTeX, to time the pipeline alone
+STUB_LATEXMK = """#!/bin/sh
+for a in "$@"; do f="$a"; done
+printf '%%PDF-1.4 stub\\n' > "${f%.tex}.pdf"
+"""
+
+
+def measure(func, number, repeat=REPEAT):
+    """
+    Returns the time (in seconds) of one call to func: the best of `repeat` rounds of `number` calls.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def imagined(exo_class, seed, l33t):
+    """
+    Returns an exercice imagined with a fixed seed.
+    """
+    exo = exo_class(random.Random(seed), verbose=False)
+    exo.imagine(l33t)
+    return exo
+
+
+def nested_tree(depth, rng):
+    """
+    Returns a composition of tasks with `depth` levels of alternating sequential and parallel compositions,
+    each of 2 or 3 children.
+    """
+    counter = [0]
+
+    def build(level, kind):
+        if level == depth:
+            counter[0] += 1
+            return generator.TaskNode("task", counter[0])
+        other = "par" if kind == "seq" else "seq"
+        return generator.TaskNode(kind, children=[build(level + 1, other) for _ in range(rng.randint(2, 3))])
+
+    return build(0, "seq")
+
+
+def exercice_benchmarks():
+    """
+    Yields (name, function, number) for imagine(), question() and correction() of each exercice,
+    in each language and at each l33t level. Each function runs on all the SEEDS.
+    """
+    for name, exo_class in generator.EXERCICES.items():
+        for l33t in L33T_LEVELS:
+            yield (f"{name}.imagine[l33t={l33t}]",
+                   lambda exo_class=exo_class, l33t=l33t: [imagined(exo_class, seed, l33t) for seed in SEEDS], 1)
+            exercices = [imagined(exo_class, seed, l33t) for seed in SEEDS]
+            for lang in LANGS:
+                yield (f"{name}.question[{lang},l33t={l33t}]",
+                       lambda exercices=exercices, lang=lang, l33t=l33t: [e.question(lang, l33t) for e in exercices], 1)
+                yield (f"{name}.correction[{lang},l33t={l33t}]",
+                       lambda exercices=exercices, lang=lang, l33t=l33t: [e.correction(lang, l33t) for e in exercices], 1)
+
+
+def l33t_benchmarks():
+    """
+    Yields the benchmarks of to_l33t() on the LaTeX code of a sheet, without its cache.
+    """
+    text = "".join(generator.build_sheet(generator.SheetConfig(seed=0)))
+    for level in L33T_LEVELS[1:]:
+        yield f"to_l33t[level={level},{len(text)} chars]", lambda level=level: generator.to_l33t.__wrapped__(text, level), 10
+
+
+def tree_benchmarks():
+    """
+    Yields the benchmarks of the compositions of tasks, with growing sizes and depths.
+    """
+    for size in TREE_SIZES:
+        rng = random.Random(0)
+        yield (f"trees.sample_composition[tasks={size}]",
+               lambda rng=rng, size=size: generator.sample_composition(rng, size, size // 2), 20)
+
+    for depth in TREE_DEPTHS:
+        tree = nested_tree(depth, random.Random(depth))
+        parallel, pseudocode = tree.to_parallel(), tree.to_pseudocode()
+        number = max(1, 256 >> depth)
+        yield f"trees.to_parallel[depth={depth}]", tree.to_parallel, number
+        yield f"trees.to_pseudocode[depth={depth}]", tree.to_pseudocode, number
+        yield f"trees.canonical[depth={depth}]", tree.canonical, number
+        yield f"trees.parse_parallel[depth={depth}]", lambda p=parallel: generator.parse_parallel(p), number
+        yield f"trees.parse_pseudocode[depth={depth}]", lambda p=pseudocode: generator.parse_pseudocode(p), number
+
+
+def sequence_benchmarks():
+    """
+    Yields the benchmarks of the series of states, with growing lengths.
+    """
+    exo = generator.ProcessStateExercice(random.Random(0), verbose=False)
+    rng = random.Random(0)
+    for length in SEQUENCE_LENGTHS:
+        seq = "".join(rng.choice(exo.state_codes) for _ in range(length))
+        number = max(1, 20000 // length)
+        for lang in LANGS:
+            yield (f"states.get_wrong_transitions[{lang},length={length}]",
+                   lambda seq=seq, lang=lang: exo.get_wrong_transitions(seq, lang), number)
+        yield f"states.sequence_number[length={length}]", lambda seq=seq: exo.sequence_number(seq), number
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        return
+    for length in SEQUENCE_LENGTHS[:3]:
+        yield (f"states.bulk_sequences[10000x{length}]",
+               lambda length=length: exo.bulk_sequences(10000, length, length, seed=0), 1)
+
+
+def sheet_benchmarks(latex=True):
+    """
+    Yields the benchmarks of whole sheets: building their sources, and generating their PDFs with a stub latexmk,
+    and with the real one if it is installed and latex is True.
+    """
+    config = generator.SheetConfig(seed=0)
+    for l33t in L33T_LEVELS:
+        for lang in LANGS:
+            sheet = config.replace(lang=lang, l33t=l33t)
+            yield f"build_sheet[{lang},l33t={l33t}]", lambda sheet=sheet: generator.build_sheet(sheet), 10
+
+    real = shutil.which("latexmk")
+    stub = tempfile.mkdtemp(prefix="opensye-bench-")
+    with open(os.path.join(stub, "latexmk"), "w") as script:
+        script.write(STUB_LATEXMK)
+    os.chmod(os.path.join(stub, "latexmk"), stat.S_IRWXU)
+
+    def with_stub():
+        path = os.environ.get("PATH", "")
+        os.environ["PATH"] = stub + os.pathsep + path
+        try:
+            generator.generate_sheet(config)
+        finally:
+            os.environ["PATH"] = path
+
+    yield "generate_sheet[stub latexmk]", with_stub, 5
+    if real is not None and latex:
+        yield "generate_sheet[latexmk]", lambda: generator.generate_sheet(config), 1
+    shutil.rmtree(stub)
+
+
+def startup_benchmarks():
+    """
+    Yields the benchmarks of the startup of the generator in a new interpreter: printing its help,
+    importing it, and listing the exercices, which discovers the plugins.
+    """
+    script = os.path.abspath(generator.__file__)
+
+    def python(*args):
+        subprocess.run([sys.executable, *args], cwd=os.path.dirname(script), stdout=subprocess.DEVNULL, check=True)
+
+    yield "startup[python]", lambda: python("-c", "pass"), 3
+    yield "startup[generator.py --help]", lambda: python(script, "--help"), 3
+    yield "startup[import generator]", lambda: python("-c", "import generator"), 3
+    yield "startup[import generator, list exercices]", lambda: python("-c", "import generator; list(generator.EXERCICES)"), 3
+
+
+def run(benchmarks, selection=None, repeat=REPEAT):
+    """
+    Runs the benchmarks whose name contains selection, and returns their times by name.
+    """
+    results = {}
+    for name, func, number in benchmarks:
+        if selection is not None and selection not in name:
+            continue
+        results[name] = measure(func, number, repeat)
+    return results
+
+
+def report(results, baseline=None, threshold=THRESHOLD):
+    """
+    Prints the results, compared to the baseline if any.
+    Returns the names of the benchmarks slower than threshold times their baseline.
+    """
+    regressions = []
+    width = max(len(name) for name in results)
+    for name, seconds in results.items():
+        line = f"{name:<{width}} {seconds * 1e6:12.1f} µs"
+        if baseline is not None and baseline.get(name):
+            ratio = seconds / baseline[name]
+            line += f"  x{ratio:.2f}"
+            if ratio > threshold:
+                line += "  SLOWER"
+                regressions.append(name)
+            elif ratio < 1 / threshold:
+                line += "  faster"
+        print(line)
+    return regressions
+
+
+if __name__ == "__main__":
+    try:
+        opts, _ = getopt.getopt(sys.argv[1:], "hk:", ["help", "save=", "compare=", "threshold=",
+                                                     "repeat=", "no-latex"])
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(2)
+
+    save = None
+    compare = None
+    selection = None
+    repeat = REPEAT
+    threshold = THRESHOLD
+    latex = True
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print("Usage: ./benchmark.py [options]")
+            print("-k <text>\t\tOnly runs the benchmarks whose name contains <text>.")
+            print("--save <file>\t\tSaves the results as a JSON baseline.")
+            print("--compare <file>\tCompares the results with a baseline saved by --save.")
+            print(f"--threshold <x>\t\tA benchmark slower than x times its baseline is a regression (defaults to {THRESHOLD}).")
+            print(f"--repeat <N>\t\tKeeps the best of N rounds (defaults to {REPEAT}).")
+            print("--no-latex\t\tDo not time the real latexmk, even if it is installed.")
+            sys.exit()
+        if opt == "-k":
+            selection = arg
+        if opt == "--save":
+            save = arg
+        if opt == "--compare":
+            compare = arg
+        if opt == "--threshold":
+            threshold = float(arg)
+        if opt == "--repeat":
+            repeat = int(arg)
+        if opt == "--no-latex":
+            latex = False
+
+    baseline = None
+    if compare is not None:
+        with open(compare) as f:
+            baseline = json.load(f)["results"]
+
+    benchmarks = [startup_benchmarks(), exercice_benchmarks(), l33t_benchmarks(), tree_benchmarks(), sequence_benchmarks(),
+                  sheet_benchmarks(latex)]
+    results = {}
+    for group in benchmarks:
+        results.update(run(group, selection, repeat))
+    if not results:
+        print("No benchmark selected.")
+        sys.exit(2)
+    regressions = report(results, baseline, threshold)
+
+    if save is not None:
+        with open(save, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                       "date": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results}, f, indent=1)
+        print(f"Saved the results to {save}.")
+    if regressions:
+        print(f"{len(regressions)} benchmarks are more than {threshold} times slower than the baseline.")
+        sys.exit(1)
@@ -5,16 +5,67 @@
 # It assumes you have an installed LaTeX distribution on your system,
 # or any package that provides the `latexmk` command.
 
+import array
+import atexit
+import collections
+import collections.abc
+import contextlib
+import copy
 import datetime
+import functools
 import getopt
+import hashlib
+import importlib.util
+import json
 import os
 import random
+import re
+import shutil
 import subprocess
 import sys
+import tempfile
+import textwrap
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+# asyncio, concurrent.futures, http.server, csv, html... are imported by the functions using them, as they take
+# most of the startup time
 
 # Constant definitions. They can be changed by using command line options.
 YEAR = datetime.datetime.now().year
 NEXERCICES = 2
+EXERCICE_NAMES = None  # all the exercices found
+EXERCICE_WEIGHTS = {}
+DIFFICULTY = "medium"
+STUDENTS = []
+SEED = None
+RESUME = False
+REPLAY = None
+JOBS = None
+MERGED = False
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "opensye")
+USE_FORMAT = True
+LEAN = True
+PDF_CACHE_SIZE = 200  # MB, 0 disables the PDF cache
+SCRATCH_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None  # None for the system temporary folder
+SCRATCH_QUOTA = 256  # MB
+KEEP_SCRATCH = "failed"
+USE_SCRATCH = True
+SERVE = False
+PORT = 8000
+GRADE = None
+GRADES_OUTPUT = "grades.csv"
+UNIQUE = None
+METRICS = None
+FORMAT = "latex"
+PROFILE = None
+LATEXMK_TAIL = 40  # lines of latexmk output shown when a compilation fails
+RETRIES = 2  # exercices drawn again per sheet when they cause LaTeX errors or overfull boxes
+OVERFULL_TOLERANCE = 1.0  # pt, smaller overfull boxes are not visible
 AUTHOR = "The Internet"
 FILENAME = "my_first_SYE_exercice.tex"
 LANG = "FR"
@@ -22,531 +73,3137 @@ L33TLVL = 0
 TITLE_FR = "Mon premier TD de SYE"
 TITLE_EN = "My first Operating Systems exam"
 
+# ============= Layout estimation ===========================
+# ============================================================
+# A rough model of 11pt Computer Modern in the 17cm x 24cm text block of the sheets, precise enough
+# to detect the questions which would overflow the page before running LaTeX.
+
+TEXT_WIDTH = 17 / 2.54 * 72.27  # pt
+TEXT_HEIGHT = 24 / 2.54 * 72.27  # pt
+BASELINE_SKIP = 13.6  # pt
+EM = 10.95  # pt
+MAX_RESAMPLES = 50
+CHAR_WIDTHS = {" ": 0.333, "|": 0.278, "(": 0.389, ")": 0.389, ".": 0.278, ",": 0.278, ";": 0.278,
+               ":": 0.278, "'": 0.278, "i": 0.278, "l": 0.278, "j": 0.306, "t": 0.389, "f": 0.306,
+               "r": 0.392, "m": 0.833, "w": 0.722, "\u2192": 1.0}
+
+
+def estimate_width(text):
+    """
+    Estimates the natural width of a line of text, in pt.
+    """
+    width = 0.0
+    for c in text:
+        if c in CHAR_WIDTHS:
+            width += CHAR_WIDTHS[c]
+        elif c.isupper():
+            width += 0.722
+        else:
+            width += 0.5
+    return width * EM
+
+
+def estimate_paragraph_height(text):
+    """
+    Estimates the height of a paragraph broken between words, in pt.
+    """
+    lines = 1
+    line = 0.0
+    space = estimate_width(" ")
+    for word in text.split():
+        w = estimate_width(word)
+        if line and line + space + w > TEXT_WIDTH:
+            lines += 1
+            line = w
+        else:
+            line += (space if line else 0) + w
+    return lines * BASELINE_SKIP
+
+
+def estimate_verbatim(block):
+    """
+    Estimates the width of the widest line and the height of a verbatim block (tabs are written as 4 spaces), in pt.
+    """
+    lines = block.expandtabs(4).split("\n")
+    return max(len(line) for line in lines) * 0.525 * EM, len(lines) * BASELINE_SKIP
+
+
+def fits_page(width, height):
+    """
+    Tells if an exercice whose layout() is (width, height) fits in the text block of a page.
+    """
+    return width <= TEXT_WIDTH and height <= TEXT_HEIGHT
+
+
 # ============= Exercices classes ===========================
 # ============================================================
 # They represent a template of an exercise and can be instanciated into
 # a real problem.
-# They all own a series of methods:
+# They are built with the random generator to draw from (the random module by default),
+# and they all own a series of methods:
 # .imagine() conceives a theoretical problem and stores its parameters in internal static members
 # .question() which generates the LaTeX code to an understandable state
 # .correction() which generates the LaTeX code to an understandable correction state
 
 
-class ProcessStateExercice:
+# The static texts of the sheets, by language. They are translated to l33t-5p34k once per level by catalog_text().
+CATALOG = {
+    "FR": {
+        "subject": "Systèmes d'exploitation (SYE)",
+        "correction": " (Correction)",
+        "states.statement": ("\\section{Suite d'états de processus}\n\n"
+                             "Les processus dans un système d’exploitation ont très souvent un état. "
+                             "Définissez l’état d’un processus et expliquez son utilité. "
+                             "Rappelez le schéma des transitions entre états qu’un processus peut subir (son cycle de vie) et expliquez chaque transition.\n"
+                             "Pour chaque suite d'états dans la liste suivante, indiquez si elle est possible ou non et argumentez votre réponse. \n\n"),
+        "states.answers": ("\\section{Suite d'états de processus}\n\n"
+                           "Voici les réponses pour l'exercice Suite des états de processus.\n\n"),
+        "states.correct": "Cette suite d'états de processus était correcte.",
+        "states.wrong": "Cette suite d'états de processus était fausse. ",
+        "states.transition": "La transition {} vers {} est impossible. ",
+        "states.names": {"E": "Extérieur", "P": "Prêt", "X": "Exécution",
+                         "S": "Suspendu", "A": "Attente", "T": "Terminé"},
+        "trees.statement": """
+            \\section{Ecriture de programmes parallèles}
+
+            La plupart des librairies de programmation parallèle fournissent des primitives réalisant la \\textit{composition parallèle} : la mise en parallèle de plusieurs tâches.
+            Le paradigme de programmation impérative fournit à son tour la composition séquentielle : l'exécution de plusieurs tâches l'une à la suite de l'autre.\\
+
+            La composition parallèle est souvent écrite en utilisant le symbole ||, alors que la composition séquentielle est notée en juxtaposant les tâches. Par exemple, $(T_1||T_2)T_3$ exprime la composition 
+            parallèle des tâches $T_1$ et $T_2$, et ensuite la composition séquentielle du résultat avec la tâche $T_3$.\\
+
+            Cependant, lorsqu'on souhaite décrire dans un pseudocode le contenu de tâches composées, il est plus pratique d'utiliser des constructions \\textbf{parbegin / parend} pour la composition parallèle et \\textbf{begin/end} pour la composition
+            séquentielle. L'exemple précédent s'exprimerait avec ces constructions comme ceci:\\
+            \\begin{verbatim}
+            begin
+                parbegin
+                    T1;
+                    T2;
+                parend;
+                T3;
+            end;
+            \\end{verbatim}
+
+            Ecrivez les expressions suivantes avec les constructions \\textbf{parbegin / parend} et \\textbf{begin / end} :\\\\
+            """,
+        "trees.reverse": "\nA l'inverse, convertissez ce pseudo-code en formulation compacte à l'aide des opérateurs ||: \\\\",
+        "trees.reverse plural": "\nA l'inverse, convertissez ces pseudo-codes en formulation compacte à l'aide des opérateurs ||: \\\\",
+        "trees.answers": ("\\section{Ecriture de programmes parallèles}\n\n"
+                          "Voici les réponses pour l'exercice Ecriture de programmes parallèles.\n\n"),
+    },
+    "EN": {
+        "subject": "Operating Systems",
+        "correction": " (Correction)",
+        "states.statement": ("\\section{Process states series}\n\n"
+                             "Processes in an operating system are almost often described by a state. "
+                             "Define what is a process state and explain its uses. "
+                             "Draw the possible relations of transition between the states (the proces life cycle) and explain each of the transitions.\n"
+                             "For each series of states in the following list, indicate if it is likely to occur in real life or not, and argue. \n\n"),
+        "states.answers": ("\\section{Process states series}\n\n"
+                           "Here are the answers for the Process states series exercice.\n\n"),
+        "states.correct": "This series of process states was correct.",
+        "states.wrong": "This series of process states was wrong. ",
+        "states.transition": "The transition {} towards {} is not possible. ",
+        "states.names": {"E": "External", "P": "Ready", "X": "Execution",
+                         "S": "Suspended", "A": "Waiting", "T": "Terminated"},
+        "trees.statement": """
+            \\section{Write parallel programs}
+
+            Most of the parallel programming libraries provide templates implementing the \\textit{parallel composition} : the side-by-side execution of several tasks.
+            The imperative programming paradigm also provides the sequential composition : execution of tasks successively, each after the previous one.\\
+
+            The parallel composition is often written using the || symbol, while the sequential composition is written by putting tasks next to each other. As an example, $(T_1||T_2)T_3$ describes the parallel composition 
+            of tasks $T_1$ et $T_2$, and then the sequential composition of the result with task $T_3$.\\
+
+            However, when one wants to describe in pseudocode an ensemble of composed tasks, it is more convenient to use \\textbf{parbegin / parend} keywords for the parallel comparison, 
+            and \\textbf{begin/end} for sequential composition. The previous example would be expressed using these constructions in the following way:\\\\
+            \\begin{verbatim}
+            begin
+                parbegin
+                    T1;
+                    T2;
+                parend;
+                T3;
+            end;
+            \\end{verbatim}
+
+            Write the following expressions using the \\textbf{parbegin / parend} and \\textbf{begin / end} formulations:\\\\
+            """,
+        "trees.reverse": "\nOn the opposite, convert this pseudocode into a compact formulation using the || operator: \\\\",
+        "trees.reverse plural": "\nOn the opposite, convert these pseudocodes into compact formulations using the || operator: \\\\",
+        "trees.answers": ("\\section{Write parallel programs}\n\n"
+                          "Here are the answers for exercice Write parallel programs.\n\n"),
+    },
+}
+
+
+@functools.lru_cache(maxsize=None)
+def catalog_text(key, lang, l33t=0):
+    """
+    Returns a static text of the CATALOG in a language, translated to l33t level l33t.
+    Each (text, language, level) is only translated once, then shared by all the sheets.
+    """
+    return to_l33t(CATALOG[lang][key], l33t)
+
+
+class ProcessStateExercice:
+    """
+    A kind of exercice where a series of states is proposed, and the student
+    should tell if this series is realistic or obviously impossible.
+    """
+
+    state_codes = "EPXSAT"  # integer coding of the states used by bulk_sequences()
+    packages = ()  # the LaTeX packages used by the questions and corrections, besides BASE_PACKAGES
+    lengths = {"easy": (4, 6), "medium": (5, 8), "hard": (7, 10)}  # lengths of the series, by difficulty
+
+    def __init__(self, rng=None, verbose=True, index=None, difficulty="medium"):
+        self.rng = random if rng is None else rng
+        self.verbose = verbose
+        self.index = index
+        self.difficulty = difficulty
+        self.questions = []
+        self.corrections = []
+        self.transition_map = {"E": ["P"], "P": ["X", "S"], "X": [
+            "T", "A", "P"], "S": ["P", "A"], "A": ["P", "S"], "T": []}
+
+    def imagine(self, l33t=0):
+        """
+        Imagines a series of states which should be near possible.
+        The series are drawn again if they would not fit on a page.
+        """
+        self.resamples = 0
+        while True:
+            n_questions = self.rng.randint(3, 5)
+            self.questions = []
+            self.corrections = []
+            taken = set()
+            for q in range(n_questions):
+                if self.index is None:
+                    seq, is_feasible = self.draw_sequence()
+                else:
+                    seq, is_feasible = self.index.draw(self.draw_sequence, lambda d: f"S{self.sequence_number(d[0])}", taken)
+                self.questions.append(seq)
+                self.corrections.append(is_feasible)
+            if fits_page(*self.layout()) or self.resamples == MAX_RESAMPLES:
+                break
+            self.resamples += 1
+        if self.index is not None:
+            self.index.add(taken)
+
+        if self.verbose:
+            print("Generated a series of process states: ", "\n\t",
+                  self.questions, '\n\t', self.corrections, '\n')
+            if self.resamples:
+                print(f"\t(drawn {self.resamples+1} times to fit on a page)\n")
+
+    def draw_sequence(self):
+        """
+        Draws a series of states, and tells if it is feasible.
+        """
+        seq_len = self.rng.randint(*self.lengths[self.difficulty])
+        seq = ""
+        is_feasible = True
+        for state in range(seq_len):
+            newstate = ""
+            if self.rng.random() < 0.1:
+                # Let's do a non-feasible sequence
+                is_feasible = False
+
+                if state:
+                    # This is not the first state of the series, there is a previous one, seq[state-1]
+                    possibles = ['E', 'P', 'X', 'S', 'T', 'A']
+                    # remove the True solutions
+                    for x in self.transition_map[seq[state-1]]:
+                        possibles.remove(x)
+                    possibles.remove(seq[state-1])  # remove itself
+                    newstate = self.rng.choice(possibles)
+                else:  # This is the first state of the series. Being impossible is, being not E
+                    newstate = self.rng.choice("PXSTA")
+
+            else:
+                # Let's keep it feasible for now
+
+                if state:
+                    if seq[state-1] == 'T':
+                        # the previous was T, the only possibility is to terminate early, now
+                        break
+                    possibles = self.transition_map[seq[state-1]]
+
+                    if 'T' in possibles and state == seq_len-1:
+                        # This is the last state of the sequence and we want it to be possible
+                        newstate = 'T'
+                    else:
+                        newstate = self.rng.choice(possibles)
+                else:
+                    # The only right way to start is to start by E
+                    newstate = 'E'
+
+            seq += newstate
+        return seq, is_feasible
+
+    def sequence_number(self, seq):
+        """
+        Codes a series of states as an integer (in base 7, as the states are numbered from 1 in state_codes).
+        """
+        number = 0
+        for state in seq:
+            number = 7 * number + self.state_codes.index(state) + 1
+        return number
+
+    def layout(self):
+        """
+        Estimates the size of the imagined questions once typeset: returns the width of the widest
+        unbreakable box and the height of the questions, in pt.
+        The state series are broken between words, so only their height matters.
+        """
+        width = 0
+        height = 0
+        for state_map in (CATALOG[lang]["states.names"] for lang in CATALOG):
+            for i, seq in enumerate(self.questions):
+                words = [f"{i+1}."] + [state_map[state] + " \u2192" for state in seq]
+                width = max(width, max(estimate_width(w) for w in words))
+            height = max(height, sum(estimate_paragraph_height(f"{i+1}. " + " \u2192 ".join(state_map[st] for st in seq))
+                                     for i, seq in enumerate(self.questions)))
+        return width, height
+
+    def bulk_sequences(self, n, min_len=5, max_len=8, infeasible_rate=0.1, seed=None):
+        """
+        Generates n state sequences at once, to build question banks, with a random walk on transition_map.
+        Exactly round(n*infeasible_rate) of them are made infeasible by replacing one of their states
+        by a state that cannot follow the previous one.
+        Requires numpy. Returns four arrays:
+        - sequences: (n, max_len) int8 codes of the states (indices in state_codes), padded with -1,
+        - lengths: (n,) number of states in each sequence,
+        - feasible: (n,) booleans,
+        - wrong: (n, max_len) booleans, True on the states that cannot follow the previous one
+          (or, for the first state, that are not E).
+        """
+        try:
+            import numpy as np
+        except ImportError:
+            raise ImportError("bulk_sequences() requires numpy (pip install numpy)") from None
+
+        rng = np.random.default_rng(seed)
+        k = len(self.state_codes)
+        T = self.state_codes.index("T")
+        allowed = np.zeros((k, k), dtype=bool)
+        for a, nexts in self.transition_map.items():
+            for b in nexts:
+                allowed[self.state_codes.index(a), self.state_codes.index(b)] = True
+
+        # Random walk from E, uniform among the allowed next states, until T or the drawn length.
+        cumulated = np.cumsum(allowed / np.maximum(allowed.sum(axis=1, keepdims=True), 1), axis=1)
+        lengths = rng.integers(min_len, max_len + 1, size=n)
+        sequences = np.full((n, max_len), -1, dtype=np.int8)
+        sequences[:, 0] = self.state_codes.index("E")
+        for pos in range(1, max_len):
+            prev = sequences[:, pos-1].clip(0)
+            alive = (pos < lengths) & (sequences[:, pos-1] >= 0) & (prev != T)
+            nexts = np.minimum((rng.random(n)[:, None] >= cumulated[prev]).sum(axis=1), k-1)
+            # As in imagine(), a sequence which can terminate on its last state does.
+            nexts[(pos == lengths - 1) & allowed[prev, T]] = T
+            sequences[alive, pos] = nexts[alive]
+        lengths = (sequences >= 0).sum(axis=1)
+
+        # Wrong states: anything but E to start, or any state unreachable from the previous one (but itself)
+        candidates = [[b for b in range(k) if b != a and not allowed[a, b]] for a in range(k)]
+        candidates.append([b for b in range(k) if self.state_codes[b] != "E"])
+        n_candidates = np.array([len(c) for c in candidates])
+        table = np.array([c + [-1] * (k - len(c)) for c in candidates], dtype=np.int8)
+
+        bad = rng.choice(n, size=int(round(n * infeasible_rate)), replace=False)
+        pos = (rng.random(len(bad)) * lengths[bad]).astype(np.int64)
+        prev = np.where(pos > 0, sequences[bad, np.maximum(pos-1, 0)], k)
+        sequences[bad, pos] = table[prev, (rng.random(len(bad)) * n_candidates[prev]).astype(np.int64)]
+
+        valid = sequences >= 0
+        wrong = np.zeros((n, max_len), dtype=bool)
+        wrong[:, 0] = sequences[:, 0] != self.state_codes.index("E")
+        wrong[:, 1:] = valid[:, 1:] & ~allowed[sequences[:, :-1].clip(0), sequences[:, 1:].clip(0)]
+        feasible = ~wrong.any(axis=1)
+        return sequences, lengths, feasible, wrong
+
+    def sequences_to_strings(self, sequences, lengths):
+        """
+        Converts sequences coded by bulk_sequences() back to strings of state letters, as in self.questions.
+        """
+        return ["".join(self.state_codes[c] for c in seq[:length]) for seq, length in zip(sequences.tolist(), lengths.tolist())]
+
+    def statement(self, LANG, l33t=0):
+        """
+        Returns the LaTeX statement of the exercice, before the questions.
+        """
+        return catalog_text("states.statement", LANG, int(l33t > 0))
+
+    def question(self, LANG, l33t=0):
+        """
+        Generates a LaTeX states of the imagined questions.
+        """
+        state_map = CATALOG[LANG]["states.names"]
+        guidelines = self.statement(LANG, l33t)
+
+        spacer = ' $\\rightarrow$ '
+        for i in range(len(self.questions)):
+            state_path = [state_map[state] for state in self.questions[i]]
+            guidelines += f'{i+1}. {(spacer).join(state_path)}\n\n'
+
+        return guidelines
+
+    def correction(self, LANG, l33t=0):
+        """
+        Generates a LaTeX states of the correction of the imagined questions.
+        Only the answers are translated to l33t here, the static texts are translated once by catalog_text().
+        """
+        answer = catalog_text("states.answers", LANG, int(l33t > 0))
+        for i in range(len(self.corrections)):
+            answer += to_l33t(f"{i+1}. " + self.explanation(i, LANG) + "\n\n", int(l33t > 0))
+
+        return answer
+
+    def explanation(self, i, LANG):
+        """
+        Returns the answer to question i: whether its series is possible, and why.
+        """
+        if self.corrections[i]:
+            return CATALOG[LANG]["states.correct"]
+        return CATALOG[LANG]["states.wrong"] + self.get_wrong_transitions(self.questions[i], LANG)
+
+    def content(self, LANG, l33t=0):
+        """
+        Returns the questions and their answers as structured content, for the renderers other than LaTeX
+        (see latex_blocks() for the format of the blocks).
+        """
+        state_map = CATALOG[LANG]["states.names"]
+        title, statement = latex_blocks(self.statement(LANG, l33t))
+        questions = []
+        for i, (seq, feasible) in enumerate(zip(self.questions, self.corrections)):
+            questions.append({
+                "number": i+1,
+                "kind": "truefalse",
+                "truth": feasible,
+                "prompt": [("p", [(None, " → ".join(state_map[state] for state in seq))])],
+                "answer": latex_blocks(to_l33t(self.explanation(i, LANG), int(l33t > 0)))[1],
+            })
+        return {"exercice": "states", "title": title, "statement": statement,
+                "parts": [{"intro": [], "questions": questions}]}
+
+    def get_wrong_transitions(self, seq, LANG):
+        """
+        Identifies bad transitions in a sequence and output LaTeX code to explain why it is wrong.
+        """
+        answer = ""
+        for i in range(len(seq)-1):
+            if seq[i+1] not in self.transition_map[seq[i]]:
+                answer += CATALOG[LANG]["states.transition"].format(self.code_to_word(seq[i], LANG),
+                                                                    self.code_to_word(seq[i+1], LANG))
+
+        return answer
+
+    def code_to_word(self, code, LANG):
+        return CATALOG[LANG]["states.names"][code]
+
+
+class TaskNode:
+    """
+    A node of a tree of composed tasks: a task ("task", with its number), or the sequential ("seq")
+    or parallel ("par") composition of its children.
+    Trees are written in both notations by to_parallel() and to_pseudocode(), in linear time,
+    and read back by parse_parallel() and parse_pseudocode().
+    """
+
+    __slots__ = ("kind", "number", "children")
+
+    def __init__(self, kind, number=None, children=None):
+        self.kind = kind
+        self.number = number
+        self.children = [] if children is None else children
+
+    def canonical(self):
+        """
+        Returns a string identifying the composition, whatever the way it was written: nested compositions
+        of the same kind are flattened, compositions of a single child are removed, and the children of
+        parallel compositions (|| is commutative) are sorted.
+        """
+        if self.kind == "task":
+            return f"T{self.number}"
+        children = []
+        for child in self.children:
+            c = child.canonical()
+            if c.startswith(self.kind[0].upper() + "("):
+                children.extend(split_canonical(c[2:-1]))
+            else:
+                children.append(c)
+        if len(children) == 1:
+            return children[0]
+        if self.kind == "par":
+            children.sort()
+        return self.kind[0].upper() + "(" + ",".join(children) + ")"
+
+    def to_parallel(self):
+        """
+        Writes the composition with the || operator, like (T1||T2)T3.
+        """
+        parts = []
+        self.write_parallel(parts, top=True)
+        return "".join(parts)
+
+    def write_parallel(self, parts, top=False):
+        if self.kind == "task":
+            parts.append(f"T{self.number}")
+            return
+        if top and self.kind == "seq" and len(self.children) == 1:
+            self.children[0].write_parallel(parts, top=True)
+            return
+        if not top:
+            parts.append("(")
+        for i, child in enumerate(self.children):
+            if i and self.kind == "par":
+                parts.append("||")
+            child.write_parallel(parts)
+        if not top:
+            parts.append(")")
+
+    def to_pseudocode(self):
+        """
+        Writes the composition with begin/end and parbegin/parend blocks, indented with tabs.
+        """
+        lines = []
+        self.write_pseudocode(lines, 0)
+        return "\n".join(lines)
+
+    def write_pseudocode(self, lines, indent):
+        tabs = "\t" * indent
+        if self.kind == "task":
+            lines.append(f"{tabs}T{self.number};")
+            return
+        lines.append(tabs + ("begin" if self.kind == "seq" else "parbegin"))
+        for child in self.children:
+            child.write_pseudocode(lines, indent + 1)
+        lines.append(tabs + ("end;" if self.kind == "seq" else "parend;"))
+
+
+def split_canonical(inner):
+    """
+    Splits the comma-separated children of a canonical form, ignoring the commas of nested compositions.
+    """
+    parts = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(inner):
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "," and not depth:
+            parts.append(inner[start:i])
+            start = i + 1
+    parts.append(inner[start:])
+    return parts
+
+
+def parse_parallel(text):
+    """
+    Parses a composition of tasks written with the || operator, like (T1||T2)T3.
+    Juxtaposed tasks are composed sequentially. Raises ValueError if the text cannot be parsed.
+    """
+    tokens = re.findall(r"T\d+|\(|\)|\|\||\S", re.sub(r"[\s$_{}]|\\\\", "", text.upper()))
+    pos = 0
+
+    def parse_par():
+        nonlocal pos
+        children = [parse_seq()]
+        while pos < len(tokens) and tokens[pos] == "||":
+            pos += 1
+            children.append(parse_seq())
+        return children[0] if len(children) == 1 else TaskNode("par", children=children)
+
+    def parse_seq():
+        nonlocal pos
+        children = []
+        while pos < len(tokens) and tokens[pos] not in ("||", ")"):
+            if tokens[pos] == "(":
+                pos += 1
+                children.append(parse_par())
+                if pos >= len(tokens) or tokens[pos] != ")":
+                    raise ValueError(f"Missing ) in {text!r}")
+                pos += 1
+            elif tokens[pos].startswith("T") and tokens[pos][1:].isdigit():
+                children.append(TaskNode("task", int(tokens[pos][1:])))
+                pos += 1
+            else:
+                raise ValueError(f"Unexpected {tokens[pos]!r} in {text!r}")
+        if not children:
+            raise ValueError(f"Empty composition in {text!r}")
+        return children[0] if len(children) == 1 else TaskNode("seq", children=children)
+
+    tree = parse_par()
+    if pos != len(tokens):
+        raise ValueError(f"Unexpected {tokens[pos]!r} in {text!r}")
+    return tree
+
+
+def parse_pseudocode(text):
+    """
+    Parses a composition of tasks written with begin/end and parbegin/parend blocks.
+    Raises ValueError if the text cannot be parsed.
+    """
+    tokens = re.findall(r"parbegin|parend|begin|end|T\d+|[^\s;]+", text.replace("_", ""), re.IGNORECASE)
+    pos = 0
+
+    def parse_block():
+        nonlocal pos
+        if pos >= len(tokens):
+            raise ValueError(f"Unexpected end of {text!r}")
+        token = tokens[pos].lower()
+        pos += 1
+        if token in ("begin", "parbegin"):
+            closing = "end" if token == "begin" else "parend"
+            children = []
+            while pos < len(tokens) and tokens[pos].lower() != closing:
+                children.append(parse_block())
+            if pos >= len(tokens):
+                raise ValueError(f"Missing {closing} in {text!r}")
+            pos += 1
+            return TaskNode("seq" if token == "begin" else "par", children=children)
+        if token[0] == "t" and token[1:].isdigit():
+            return TaskNode("task", int(token[1:]))
+        raise ValueError(f"Unexpected {tokens[pos-1]!r} in {text!r}")
+
+    tree = parse_block()
+    if pos != len(tokens):
+        raise ValueError(f"Unexpected {tokens[pos]!r} in {text!r}")
+    return tree
+
+
+def parse_composition(text):
+    """
+    Parses a composition of tasks written in either notation.
+    """
+    if re.search(r"begin", text, re.IGNORECASE):
+        return parse_pseudocode(text)
+    return parse_parallel(text)
+
+
+TREE_ARITY = 3  # maximum number of children of a sequential or parallel composition
+
+
+@functools.lru_cache(maxsize=None)
+def count_compositions(kind, n, depth):
+    """
+    Returns the number of compositions of n tasks that can be written inside a composition of the given kind:
+    a task, or a composition of the other kind of 2 to TREE_ARITY children, with at most depth nested
+    parallel compositions. The tasks are numbered in order, so only the shape of the trees is counted.
+    """
+    count = int(n == 1)
+    if kind == "par":  # a child of a parallel composition is a task or a sequence
+        count += sum(count_tuples("seq", n, depth, k) for k in range(2, TREE_ARITY + 1))
+    elif depth > 0:  # a child of a sequence is a task or a parallel composition
+        count += sum(count_tuples("par", n, depth - 1, k) for k in range(2, TREE_ARITY + 1))
+    return count
+
+
+@functools.lru_cache(maxsize=None)
+def count_tuples(kind, n, depth, k):
+    """
+    Returns the number of lists of k children of a composition of the given kind, with n tasks in all.
+    """
+    if k == 1:
+        return count_compositions(kind, n, depth)
+    return sum(count_compositions(kind, m, depth) * count_tuples(kind, n - m, depth, k - 1)
+               for m in range(1, n - k + 2))
+
+
+def sample_composition(rng, n, depth):
+    """
+    Draws a parallel composition of 1 to TREE_ARITY groups, with exactly n tasks numbered from 1 and at most
+    depth nested parallel compositions (itself included), uniformly among all such compositions.
+    Each choice is weighted by the number of trees it leads to, counted once and cached by count_compositions().
+    """
+    counts = [count_tuples("par", n, depth - 1, k) for k in range(1, TREE_ARITY + 1)]
+    if depth < 1 or not sum(counts):
+        raise ValueError(f"No composition of {n} tasks with at most {depth} nested parallel compositions")
+    number = [1]
+
+    def pick(weights):
+        r = rng.randrange(sum(weights))
+        for i, w in enumerate(weights):
+            if r < w:
+                return i
+            r -= w
+
+    def children(kind, n, depth, k):
+        nodes = []
+        for j in range(k, 1, -1):  # draws the number of tasks of each child but the last one
+            sizes = range(1, n - j + 2)
+            m = sizes[pick([count_compositions(kind, m, depth) * count_tuples(kind, n - m, depth, j - 1)
+                            for m in sizes])]
+            nodes.append(composition(kind, m, depth))
+            n -= m
+        nodes.append(composition(kind, n, depth))
+        return nodes
+
+    def composition(parent, n, depth):
+        if n == 1:  # compositions have at least 2 children
+            number[0] += 1
+            return TaskNode("task", number[0] - 1)
+        kind = "seq" if parent == "par" else "par"
+        depth = depth if kind == "seq" else depth - 1
+        k = 2 + pick([count_tuples(kind, n, depth, k) for k in range(2, TREE_ARITY + 1)])
+        return TaskNode(kind, children=children(kind, n, depth, k))
+
+    return TaskNode("par", children=children("par", n, depth - 1, 1 + pick(counts)))
+
+
+class RunningTreeExercice:
+    """
+    An exercice to train the student to convert formulations of composed groups
+    of tasks between the operator || formulation and the 'parbegin' pseudocode.
+    """
+
+    packages = ()  # only verbatim, which is part of LaTeX
+    # (min tasks, max tasks, max nesting of parbegin blocks) of a composition, by difficulty
+    sizes = {"easy": (2, 4, 1), "medium": (4, 7, 2), "hard": (7, 11, 3)}
+
+    def __init__(self, rng=None, verbose=True, index=None, difficulty="medium"):
+        self.rng = random if rng is None else rng
+        self.verbose = verbose
+        self.index = index
+        self.difficulty = difficulty
+        self.trees = []
+        self.rev_trees = []
+        self.questions = []
+        self.corrections = []
+        self.rev_questions = []
+        self.rev_corrections = []
+
+    def draw_tree(self):
+        """
+        Draws a composition of tasks, as a sequence block containing a parallel block,
+        with a number of tasks and a nesting depth given by the difficulty.
+        """
+        low, high, depth = self.sizes[self.difficulty]
+        return TaskNode("seq", children=[sample_composition(self.rng, self.rng.randint(low, high), depth)])
+
+    def imagine(self, l33t=0):
+        """
+        Imagines compositions of tasks to convert in both ways.
+        They are drawn again if they would not fit on a page.
+        """
+        self.resamples = 0
+        while True:
+            if self.index is None:
+                self.trees = [self.draw_tree() for _ in range(self.rng.randint(3, 5))]
+                self.rev_trees = [self.draw_tree() for _ in range(self.rng.randint(1, 2))]
+            else:
+                taken = set()
+                self.trees = [self.index.draw(self.draw_tree, TaskNode.canonical, taken)
+                              for _ in range(self.rng.randint(3, 5))]
+                self.rev_trees = [self.index.draw(self.draw_tree, TaskNode.canonical, taken)
+                                  for _ in range(self.rng.randint(1, 2))]
+            self.questions = [tree.to_parallel() for tree in self.trees]
+            self.corrections = [tree.to_pseudocode() for tree in self.trees]
+            self.rev_questions = [tree.to_pseudocode() for tree in self.rev_trees]
+            self.rev_corrections = [tree.to_parallel() for tree in self.rev_trees]
+            if fits_page(*self.layout()) or self.resamples == MAX_RESAMPLES:
+                break
+            self.resamples += 1
+        if self.index is not None:
+            self.index.add(taken)
+
+        if self.verbose:
+            print(to_l33t("Generating a series of composed tasks: ",
+                          int(l33t > 0)), '\n\t', self.questions, '\n')
+            print(to_l33t("Generating a second series of composed tasks to find: ", int(l33t > 0)),
+                  '\n\t', self.rev_corrections, '\n')
+            if self.resamples:
+                print(f"\t(drawn {self.resamples+1} times to fit on a page)\n")
+
+    def layout(self):
+        """
+        Estimates the size of the imagined questions once typeset: returns the width of the widest
+        unbreakable box (of the questions or of the corrections) and the height of the questions, in pt.
+        The || expressions cannot be broken, and neither can the lines of the verbatim blocks.
+        The corrections may span several pages, so their height does not matter.
+        """
+        numbered = [f"{i+1}. {v}" for i, v in enumerate(self.questions + self.rev_corrections)]
+        width = max(estimate_width(line) for line in numbered)
+        blocks = [estimate_verbatim(block) for block in self.corrections + self.rev_questions]
+        width = max([width] + [w for w, _ in blocks])
+        height = len(self.questions) * BASELINE_SKIP
+        height += sum(h + 2 * BASELINE_SKIP for _, h in blocks[len(self.questions):])
+        return width, height
+
+    def statement(self, LANG, l33t=0):
+        """
+        Returns the LaTeX statement of the exercice, before the questions.
+        """
+        return catalog_text("trees.statement", LANG, int(l33t > 0))
+
+    def reverse_statement(self, LANG, l33t=0):
+        """
+        Returns the LaTeX statement of the second part of the exercice, from pseudocode to the || formulation.
+        """
+        return catalog_text("trees.reverse" if len(self.rev_questions) == 1 else "trees.reverse plural", LANG, int(l33t > 0))
+
+    def question(self, LANG, l33t=0):
+        """
+        Generates a LaTeX states of the imagined questions.
+        """
+        guidelines = self.statement(LANG, l33t)
+
+        for i, v in enumerate(self.questions):
+            guidelines += f"{i+1}. " + v + "\\\\\n"
+
+        guidelines += self.reverse_statement(LANG, l33t)
+
+        for i, v in enumerate(self.rev_questions):
+            guidelines += f"{i+len(self.questions)+1}" + r". \\" + '\n' + r"\begin{verbatim}" + \
+                '\n' + v.replace('\t', "    ") + '\n' + \
+                r"\end{verbatim}" + "\n~\\\\\n"
+
+        return guidelines
+
+    def correction(self, LANG, l33t=0):
+        """
+        Generates a LaTeX states of the correction of the imagined questions.
+        """
+
+        answer = catalog_text("trees.answers", LANG, int(l33t > 0))
+
+        for i, v in enumerate(self.corrections):
+            answer += f"{i+1}" + r". \\" + '\n' + r"\begin{verbatim}" + \
+                '\n' + v.replace('\t', "    ") + '\n' + \
+                r"\end{verbatim}" + "\n\n"
+        for i, v in enumerate(self.rev_corrections):
+            answer += f"\\noindent {i+len(self.corrections)+1}. " + \
+                v + "\\\\\n"
+
+        return answer
+
+    def content(self, LANG, l33t=0):
+        """
+        Returns the questions and their answers as structured content, for the renderers other than LaTeX
+        (see latex_blocks() for the format of the blocks).
+        """
+        title, statement = latex_blocks(self.statement(LANG, l33t))
+        questions = [{"number": i+1, "kind": "essay", "prompt": [("code", q)], "answer": [("code", c.replace("\t", "    "))]}
+                     for i, (q, c) in enumerate(zip(self.questions, self.corrections))]
+        rev_questions = [{"number": i+len(questions)+1, "kind": "essay",
+                          "prompt": [("code", q.replace("\t", "    "))], "answer": [("code", c)]}
+                         for i, (q, c) in enumerate(zip(self.rev_questions, self.rev_corrections))]
+        return {"exercice": "trees", "title": title, "statement": statement,
+                "parts": [{"intro": [], "questions": questions},
+                          {"intro": latex_blocks(self.reverse_statement(LANG, l33t))[1],
+                           "questions": rev_questions}]}
+
+
+class ExerciceRegistry(collections.abc.Mapping):
+    """
+    The exercice classes by name. Besides the built-in exercices, plugins are found in the modules of a folder
+    (the module exercices/graphs.py defines the exercice "graphs", whose class is its EXERCICE attribute)
+    and in the entry points of a group, declared by installed packages. Plugins are only listed at first,
+    and imported when their class is first needed, so that the startup time does not grow with the catalogue.
+    It can be shared by several threads.
+    """
+
+    def __init__(self, builtins, folder=None, group=None):
+        self.classes = dict(builtins)
+        self.loaders = {}
+        self.folder = folder
+        self.group = group
+        self.discovered = False
+        self.lock = threading.RLock()  # reentrant, for the plugins that use the registry while they are imported
+
+    def discover(self):
+        """
+        Lists the plugins of the folder, then the ones of the entry points, without importing them.
+        An exercice already registered is not overridden.
+        """
+        with self.lock:
+            if self.discovered:
+                return
+            self.discovered = True
+            if self.folder is not None and os.path.isdir(self.folder):
+                for entry in sorted(os.listdir(self.folder)):
+                    name, ext = os.path.splitext(entry)
+                    if ext == ".py" and not name.startswith("_") and name not in self.classes:
+                        self.loaders.setdefault(name, functools.partial(load_plugin, os.path.join(self.folder, entry)))
+            if self.group is not None:
+                import importlib.metadata  # takes longer to import than the rest of the generator
+                entry_points = importlib.metadata.entry_points()
+                if hasattr(entry_points, "select"):
+                    entry_points = entry_points.select(group=self.group)
+                else:  # Python < 3.10
+                    entry_points = entry_points.get(self.group, [])
+                for entry_point in entry_points:
+                    if entry_point.name not in self.classes:
+                        self.loaders.setdefault(entry_point.name, entry_point.load)
+
+    def __getitem__(self, name):
+        with self.lock:
+            if name not in self.classes:
+                if name not in self:
+                    raise KeyError(name)
+                self.classes[name] = self.loaders[name]()
+                del self.loaders[name]  # only once loaded, so that a plugin failing to import can be retried
+            return self.classes[name]
+
+    def __contains__(self, name):
+        with self.lock:
+            if name in self.classes or name in self.loaders:
+                return True
+            self.discover()
+            return name in self.loaders
+
+    def __iter__(self):
+        with self.lock:
+            self.discover()
+            return iter(list(self.classes) + list(self.loaders))
+
+    def __len__(self):
+        with self.lock:
+            self.discover()
+            return len(self.classes) + len(self.loaders)
+
+    def name_of(self, exo_class):
+        """
+        Returns the name of an exercice class already loaded, without importing the plugins not loaded yet.
+        """
+        with self.lock:
+            return next(name for name, loaded in self.classes.items() if loaded is exo_class)
+
+
+def load_plugin(path):
+    """
+    Imports the module of an exercice plugin, and returns its EXERCICE class.
+    """
+    # plugins import generator to reuse its helpers: when it runs as a script, give them this module
+    sys.modules.setdefault("generator", sys.modules[__name__])
+    name = "opensye_exercices." + os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.EXERCICE
+
+
+def parse_exercices(text):
+    """
+    Parses a comma-separated list of exercices with optional weights, like "states:2,trees".
+    Returns the names and their weights (1 by default), or raises ValueError.
+    """
+    names, weights = [], {}
+    for item in text.split(","):
+        name, _, weight = item.strip().partition(":")
+        if name not in EXERCICES:
+            raise ValueError(f"Unknown exercice {name}, use one of: {', '.join(EXERCICES)}.")
+        weights[name] = float(weight) if weight else 1.0
+        if weights[name] <= 0:
+            raise ValueError(f"The weight of {name} must be positive.")
+        if name not in names:
+            names.append(name)
+    return names, weights
+
+
+EXERCICES = ExerciceRegistry({"states": ProcessStateExercice, "trees": RunningTreeExercice},
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), "exercices"), "opensye.exercices")
+
+
+class UniquenessIndex:
+    """
+    The set of the instances already handed out, so that no two students get the same or trivially
+    equivalent questions. Instances are identified by a 64-bit hash of their canonical form
+    (the integer code of a series of states, the canonical form of a composition of tasks),
+    and the hashes can be saved to a file to check them across sessions and years.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.hashes = set()
+        self.collisions = 0
+        self.lock = threading.Lock()
+        if path is not None and os.path.isfile(path):
+            hashes = array.array("Q")
+            with open(path, "rb") as f:
+                hashes.frombytes(f.read())
+            self.hashes.update(hashes)
+        self.loaded = len(self.hashes)
+
+    @staticmethod
+    def hash(canonical):
+        return int.from_bytes(hashlib.blake2b(canonical.encode("utf8"), digest_size=8).digest(), "little")
+
+    def draw(self, draw, canonical, taken, rejections=None):
+        """
+        Calls draw() until the canonical form of the instance it returns is neither in the index nor
+        in taken (the hashes of the instances already drawn for the same exercice), at most MAX_RESAMPLES
+        times. The hash of the returned instance is added to taken, and the number of instances rejected
+        before it is appended to the list rejections, if given.
+        """
+        for rejected in range(MAX_RESAMPLES + 1):
+            instance = draw()
+            h = self.hash(canonical(instance))
+            with self.lock:
+                if h not in taken and h not in self.hashes:
+                    break
+                self.collisions += 1
+        taken.add(h)
+        if rejections is not None:
+            rejections.append(rejected)
+        return instance
+
+    def add(self, hashes):
+        """
+        Records the hashes of the instances of an imagined exercice.
+        """
+        with self.lock:
+            self.hashes.update(hashes)
+
+    def save(self):
+        """
+        Writes the hashes to the index file.
+        """
+        with self.lock:
+            data = array.array("Q", sorted(self.hashes)).tobytes()
+        folder = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=folder, suffix=".part")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+
+    def report(self):
+        """
+        Prints the size of the index and the number of instances drawn again.
+        """
+        print(f"Uniqueness index: {len(self.hashes)} instances ({len(self.hashes) - self.loaded} new), "
+              f"{self.collisions} duplicates drawn again ({self.path}).")
+
+
+class SheetDraws:
+    """
+    The draws of one sheet from a UniquenessIndex, used as the index of its exercices: for each instance drawn,
+    the number of instances rejected before it as already handed out. With these counts, the sheet is imagined
+    again identically without the index, or once the index holds its own instances (to replay, grade or redraw it):
+    the rejected instances are drawn and skipped again instead of being looked up. The draws beyond the recorded
+    ones are checked against the index, if any. Each imagining of the sheet starts again from the first draw.
+    """
+
+    def __init__(self, index=None, rejections=()):
+        self.index = index
+        self.rejections = list(rejections)
+        self.position = 0
+
+    def rewind(self):
+        self.position = 0
+
+    def draw(self, draw, canonical, taken):
+        if self.position < len(self.rejections):
+            for _ in range(self.rejections[self.position] + 1):
+                instance = draw()
+            taken.add(UniquenessIndex.hash(canonical(instance)))
+        elif self.index is not None:
+            instance = self.index.draw(draw, canonical, taken, self.rejections)
+        else:
+            instance = draw()
+            taken.add(UniquenessIndex.hash(canonical(instance)))
+            self.rejections.append(0)
+        self.position += 1
+        return instance
+
+    def add(self, hashes):
+        if self.index is not None:
+            self.index.add(hashes)
+
+
+def peak_rss():
+    """
+    Returns the peak resident memory (in kB) of this process and of its largest child process so far,
+    or (None, None) if it is not available.
+    """
+    if resource is None:
+        return None, None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+
+class Metrics:
+    """
+    Records the wall time, CPU time and memory of the phases of a run, the time spent in each exercice,
+    and the LaTeX compilations, then writes them as JSON. A disabled Metrics records nothing.
+    It can be shared by several threads.
+    """
+
+    def __init__(self, path=None, enabled=True):
+        self.path = path
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.phases = collections.OrderedDict()
+        self.records = collections.defaultdict(list)
+        self.heap_peaks = {}  # the Python heap peak of each phase running, when tracemalloc is tracing
+        self.profile = None  # the pstats.Stats of the functions run by the worker threads, when profiling
+
+    def __reduce__(self):
+        # The records of other processes (the grading workers) are not sent back
+        return (Metrics, (None, False))
+
+    def fold_heap_peak(self):
+        """
+        Adds the Python heap peak since the last call to the peaks of the phases running, and starts a new one.
+        Must be called with the lock held.
+        """
+        import tracemalloc
+        peak = tracemalloc.get_traced_memory()[1]
+        for token in self.heap_peaks:
+            self.heap_peaks[token] = max(self.heap_peaks[token], peak)
+        tracemalloc.reset_peak()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Measures a phase of the run. A phase entered several times (from several threads) adds up.
+        The high-water mark of the resident memory only grows over the life of a process: the memory of a phase
+        is how much it raised the one of the process (and of its largest child, LaTeX or a worker), which is 0 for
+        a phase using less memory than an earlier one. When tracemalloc is tracing (python -X tracemalloc), the peak
+        size of the Python heap during the phase is recorded too (from Python 3.9, which can reset the peak).
+        Its overhead is too high to trace by default.
+        """
+        if not self.enabled:
+            yield
+            return
+        import tracemalloc
+        token = object()
+        if tracemalloc.is_tracing() and hasattr(tracemalloc, "reset_peak"):
+            with self.lock:
+                self.fold_heap_peak()
+                self.heap_peaks[token] = 0
+        rss, children_rss = peak_rss()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            end_rss, end_children_rss = peak_rss()
+            with self.lock:
+                phase = self.phases.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0})
+                phase["calls"] += 1
+                phase["wall"] += wall
+                phase["cpu"] += cpu
+                if rss is not None:
+                    phase["rss_growth_kb"] = max(phase.get("rss_growth_kb", 0), end_rss - rss)
+                    phase["children_rss_growth_kb"] = max(phase.get("children_rss_growth_kb", 0),
+                                                          end_children_rss - children_rss)
+                    phase["process_peak_rss_kb"] = end_rss
+                if token in self.heap_peaks:
+                    self.fold_heap_peak()
+                    heap = self.heap_peaks.pop(token) // 1024
+                    phase["python_heap_peak_kb"] = max(phase.get("python_heap_peak_kb", 0), heap)
+
+    @contextlib.contextmanager
+    def measure(self, kind, **fields):
+        """
+        Measures the wall and CPU time (of the calling thread) of a block, and records them with fields.
+        """
+        if not self.enabled:
+            yield
+            return
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.add(kind, wall=time.perf_counter() - wall, cpu=time.thread_time() - cpu, **fields)
+
+    def run(self, function, *args):
+        """
+        Calls function(*args), in a worker thread. cProfile only profiles the thread which enabled it: when profiling,
+        the function is profiled on its own, and its statistics are added to self.profile.
+        """
+        if self.profile is None:
+            return function(*args)
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:  # from Python 3.12, the profiler of the main thread sees all the threads
+            return function(*args)
+        try:
+            return function(*args)
+        finally:
+            profiler.disable()
+            with self.lock:
+                self.profile.add(profiler)
+
+    def save_profile(self, profiler, path):
+        """
+        Writes the statistics of the profiler of the main thread, with the ones of the worker threads, to a file.
+        """
+        profiler.disable()
+        with self.lock:
+            self.profile.add(profiler).dump_stats(path)
+
+    def add(self, kind, **fields):
+        """
+        Records an event of the given kind ("exercices", "compilations"...).
+        """
+        if self.enabled:
+            with self.lock:
+                self.records[kind].append(fields)
+
+    def save(self, path=None):
+        """
+        Writes the metrics to a JSON file.
+        """
+        path = self.path if path is None else path
+        compilations = self.records.get("compilations", [])
+        with self.lock:
+            metrics = {
+                "command": sys.argv,
+                "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                "phases": self.phases,
+                "summary": {
+                    "compilations": len(compilations),
+                    "cached": sum(c["cached"] for c in compilations),
+                    "failed": sum(not c["ok"] for c in compilations),
+                    "latex_passes": sum(c["passes"] for c in compilations),
+                    "latex_warnings": sum(c["warnings"] for c in compilations),
+                    "compilation_wall": sum(c["wall"] for c in compilations),
+                },
+                **self.records}
+        with open(path, "w") as f:
+            json.dump(metrics, f, indent=1)
+        print(f"Metrics written to {path}.")
+
+
+NO_METRICS = Metrics(enabled=False)
+
+
+class SheetConfig:
+    """
+    All the parameters of a sheet. Generating a sheet only depends on its SheetConfig,
+    never on module globals, so that several sheets can be generated concurrently.
+    """
+
+    def __init__(self, lang="FR", l33t=0, year=None, seed=None, exercices=None, n_exercices=2,
+                 title=None, author=AUTHOR, student=None, index=None, lean=True, metrics=None, difficulty="medium",
+                 weights=None, redraws=None):
+        self.lang = lang
+        self.l33t = l33t
+        self.year = datetime.datetime.now().year if year is None else year
+        self.seed = seed
+        self.exercices = list(EXERCICES) if exercices is None else list(exercices)
+        self.n_exercices = n_exercices
+        self.weights = {} if weights is None else dict(weights)  # how often each exercice is picked, 1 by default
+        if title is None:
+            title = TITLE_FR if lang == "FR" else TITLE_EN
+        self.title = title
+        self.author = author
+        self.student = student
+        self.index = index  # an optional UniquenessIndex shared by the sheets, or the SheetDraws of this sheet
+        self.lean = lean  # only load the LaTeX packages used by the exercices
+        self.metrics = NO_METRICS if metrics is None else metrics
+        self.difficulty = difficulty  # the size of the questions: easy, medium or hard
+        self.redraws = [] if redraws is None else list(redraws)  # exercices imagined again, by position on the sheet
+
+    def replace(self, **changes):
+        """
+        Returns a copy of this configuration with some parameters changed.
+        """
+        config = copy.copy(self)
+        config.__dict__.update(changes)
+        return config
+
+
+leet_level_1 = {
+    "a": "4", "b": "6", "l": "|", "o": "0", "e": "3", "t": "7", "s": "5", "i": "1"
+}
+leet_level_2 = {
+    "a": "4", "b": "6", "l": "1", "o": "0", "e": "3", "t": "7",
+    "c": "(", "d": "[)", "f": "|=", "h": "#", "i": "!", "j": ",|", "k": "]{", "m": "(\\\\/)", "n": "(\\\\)", "s": "5", "u": "(_)", "v": "\\\\/", "w": "'//", "x": "\\%", "y": "'/"
+}
+leet_level_3 = {
+    "a": "/-\\\\", "b": "!3", "c": "(", "d": "|)", "e": "3", "f": "|=", "g": "(_+", "h": "]-[", "i": "!", "j": "_|", "k": "|<", "l": "|_", "m": "|\\\\/|", "n": "/\\\\/", "o": "()", "p": "|*",
+    "q": "0_", "r": "|?", "s": "5", "t": "7", "u": "|_|", "v": "\\\\/", "w": "\\\\/\\\\/", "x": "><", "y": "'/", "z": "2"
+}
+leet_tables = {1: str.maketrans(leet_level_1), 2: str.maketrans(leet_level_2), 3: str.maketrans(leet_level_3)}
+
+# The packages that can be loaded by the preamble, in loading order
+LATEX_PACKAGES = {
+    "fontenc": "\\usepackage[T1]{fontenc}",
+    "graphicx": "\\usepackage{graphicx}",
+    "grffile": "\\usepackage{grffile}",
+    "longtable": "\\usepackage{longtable}",
+    "wrapfig": "\\usepackage{wrapfig}",
+    "rotating": "\\usepackage{rotating}",
+    "ulem": "\\usepackage[normalem]{ulem}",
+    "amsmath": "\\usepackage{amsmath}",
+    "textcomp": "\\usepackage{textcomp}",
+    "amssymb": "\\usepackage{amssymb}",
+    "capt-of": "\\usepackage{capt-of}",
+    "hyperref": "\\usepackage{hyperref}",
+    "minted": "\\usepackage{minted}",
+    "tabularx": "\\usepackage{tabularx}",
+    "babel": "\\usepackage[french]{babel}",
+    "geometry": "\\usepackage[text={17cm,24cm},centering]{geometry}",
+    "enumitem": "\\usepackage{enumitem}",
+    "tikz": "\\usepackage{tikz}\n        \\usetikzlibrary{positioning,arrows.meta}",
+}
+# The packages needed by the sheet itself, whatever its exercices
+BASE_PACKAGES = ("fontenc", "hyperref", "babel", "geometry")
+# The packages that need LaTeX to run external programs, or bibtex
+SHELL_ESCAPE_PACKAGES = {"minted"}
+BIBTEX_PACKAGES = {"biblatex", "natbib", "cite"}
+
+
+def preamble_format(preamble, cache_dir):
+    """
+    Returns the path (without the .fmt extension) of a precompiled LaTeX format containing the given preamble,
+    and builds it with mylatexformat in cache_dir if it is not there yet. The format is named after a hash
+    of the preamble text and of the engine version, so a modified preamble or an upgraded engine (which cannot
+    load the formats of the previous one) automatically gets a new format. A whole source file can be
+    given: only its text up to \\endofdump is part of the format.
+    Returns None if the format cannot be built (no pdflatex or no mylatexformat on this system).
+    """
+    if "\\endofdump" not in preamble:
+        return None
+    preamble = preamble[:preamble.rindex("\\endofdump") + len("\\endofdump")] + "\n"
+    name = "opensye-" + hashlib.sha256((latex_engine_version() + "\n" + preamble).encode("utf8")).hexdigest()[:16]
+    if os.path.isfile(os.path.join(cache_dir, name + ".fmt")):
+        return os.path.join(cache_dir, name)
+    if shutil.which("pdflatex") is None:
+        return None
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=cache_dir) as build:
+        with open(os.path.join(build, name + ".tex"), "w") as tex:
+            tex.write(preamble)
+        shell_escape = ["-shell-escape"] if SHELL_ESCAPE_PACKAGES.intersection(preamble_packages(preamble)) else []
+        subprocess.run(["pdflatex", "-ini", *shell_escape, "-interaction=nonstopmode", f"-jobname={name}",
+                        "&pdflatex", "mylatexformat.ltx", name + ".tex"], cwd=build, capture_output=True)
+        if not os.path.isfile(os.path.join(build, name + ".fmt")):
+            return None
+        # Atomic, so that concurrent runs never load a half-written format
+        os.replace(os.path.join(build, name + ".fmt"), os.path.join(cache_dir, name + ".fmt"))
+    return os.path.join(cache_dir, name)
+
+
+def preamble_cost(preamble, cache_dir, formats=None):
+    """
+    Returns the time (in seconds) latexmk takes to compile an almost empty document with the given preamble,
+    that is what loading the preamble costs to each compilation. It is measured once per preamble,
+    and remembered in cache_dir/preamble-timings.json. Returns None if it cannot be measured.
+    """
+    key = hashlib.sha256(preamble.encode("utf8")).hexdigest()[:16] + ("-format" if formats is not None else "")
+    path = os.path.join(cache_dir, "preamble-timings.json")
+    try:
+        with open(path) as f:
+            timings = json.load(f)
+    except (OSError, ValueError):
+        timings = {}
+    if key in timings:
+        return timings[key]
+    if shutil.which("latexmk") is None:
+        return None
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=cache_dir) as build:
+        with open(os.path.join(build, "empty.tex"), "w") as tex:
+            tex.write(preamble + "\\begin{document}\\null\\end{document}\n")
+        command, env = latexmk_options(os.path.join(build, "empty.tex"), formats)
+        start = time.perf_counter()
+        subprocess.run(command, cwd=build, env=env, capture_output=True)
+        timings[key] = time.perf_counter() - start
+        if not os.path.isfile(os.path.join(build, "empty.pdf")):
+            return None
+
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".part")
+    with os.fdopen(fd, "w") as f:
+        json.dump(timings, f, indent=1)
+    os.replace(tmp, path)
+    return timings[key]
+
+
+def report_lean_preamble(packages, compilations, cache_dir, formats=None):
+    """
+    Prints the packages left out of the lean preamble, and the compilation time it saves.
+    """
+    full = preamble_cost(latex_preamble(), cache_dir, formats)
+    lean = preamble_cost(latex_preamble(packages), cache_dir, formats)
+    print(f"Lean preamble: {len(packages)} LaTeX packages loaded out of {len(LATEX_PACKAGES)}.")
+    if full is not None and lean is not None:
+        print(f"\tabout {full - lean:.2f} s saved per compilation ({full:.2f} s with all the packages, "
+              f"{lean:.2f} s with the lean preamble), {compilations * (full - lean):.1f} s for this run.")
+
+
+@functools.lru_cache(maxsize=None)
+def latex_engine_version():
+    """
+    Returns the version banner of the LaTeX engine, which is part of the PDF cache keys and of the format names.
+    """
+    try:
+        out = subprocess.run(["pdflatex", "--version"], capture_output=True, text=True).stdout
+    except OSError:
+        return "pdflatex"
+    return out.splitlines()[0] if out else "pdflatex"
+
+
+class PdfCache:
+    """
+    A content-addressed cache of compiled PDFs. The PDFs are stored in a folder, named after the SHA-256
+    of their LaTeX source and of the engine version. When the folder grows over max_size bytes,
+    the least recently used PDFs are removed.
+    """
+
+    def __init__(self, folder, max_size):
+        self.folder = folder
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def key(self, texfile):
+        """
+        Computes the cache key of a LaTeX source file.
+        """
+        h = hashlib.sha256(latex_engine_version().encode("utf8"))
+        with open(texfile, "rb") as tex:
+            h.update(tex.read())
+        return h.hexdigest()
+
+    def fetch(self, key, pdf):
+        """
+        Hard-links (or copies, across filesystems) the cached PDF to the path pdf.
+        Returns False if there is no PDF for this key.
+        """
+        cached = os.path.join(self.folder, key + ".pdf")
+        try:
+            os.utime(cached)  # mark it as recently used
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return False
+        if os.path.exists(pdf):
+            os.remove(pdf)
+        try:
+            os.link(cached, pdf)
+        except OSError:
+            shutil.copyfile(cached, pdf)
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def store(self, key, pdf):
+        """
+        Adds a compiled PDF to the cache, then evicts the oldest entries if the cache is too big.
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.folder, suffix=".part")
+        os.close(fd)
+        shutil.copyfile(pdf, tmp)
+        os.replace(tmp, os.path.join(self.folder, key + ".pdf"))
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used PDFs until the cache fits in max_size bytes.
+        """
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.folder):
+                if entry.name.endswith(".pdf"):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+            total = sum(e[1] for e in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass  # already evicted by a concurrent run
+                total -= size
+
+    def report(self):
+        """
+        Prints the hit and miss counters.
+        """
+        print(f"PDF cache: {self.hits} hits, {self.misses} misses ({self.folder}).")
+
+
+class Workspaces:
+    """
+    Private scratch folders for the LaTeX compilations, under a RAM-backed folder like /dev/shm.
+    Each compilation runs in its own folder, so that concurrent compilations never share their
+    intermediate files (.aux, .log, .fls, .fdb_latexmk, _minted-*), and only the PDF, .log and .aux are copied
+    back to the working folder. A folder is removed once its compilation is done, or kept if it failed
+    (or always, with keep="always"), the oldest kept folders being removed to stay under quota bytes.
+    """
+
+    copied_back = (".pdf", ".log", ".aux")
+
+    def __init__(self, root=None, quota=256 * 1024 * 1024, keep="failed"):
+        self.root = tempfile.gettempdir() if root is None else root
+        self.quota = quota
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.kept = collections.OrderedDict()  # the sizes of the kept folders, oldest first
+        self.compilations = 0
+        self.written = 0  # bytes of the files left by the compilations
+        self.largest = 0
+        self.fallbacks = 0
+
+    @contextlib.contextmanager
+    def open(self, workdir, filename, metrics=NO_METRICS):
+        """
+        Creates a scratch folder with the source filename of workdir (and its .aux, if a previous compilation
+        left one, to save a LaTeX pass) and yields its path. When the block ends, copies the PDF, .log and .aux
+        back to workdir, measures the files written, and removes the folder unless it is kept.
+        If the scratch filesystem has less than quota bytes free, the system temporary folder is used instead.
+        """
+        root = self.root
+        if shutil.disk_usage(root).free < self.quota:
+            root = tempfile.gettempdir()
+            with self.lock:
+                self.fallbacks += 1
+        path = tempfile.mkdtemp(prefix="opensye-", dir=root)
+        base = os.path.splitext(filename)[0]
+        for name in (filename, base + ".aux"):
+            if os.path.isfile(os.path.join(workdir, name)):
+                shutil.copyfile(os.path.join(workdir, name), os.path.join(path, name))
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(workdir, base + ".pdf"))  # so that a failed compilation leaves no PDF
+        try:
+            yield path
+        finally:
+            for ext in self.copied_back:
+                if os.path.isfile(os.path.join(path, base + ext)):
+                    shutil.copy2(os.path.join(path, base + ext), os.path.join(workdir, base + ext))
+            files, size = 0, 0
+            for folder, _, names in os.walk(path):
+                files += len(names)
+                size += sum(os.path.getsize(os.path.join(folder, name)) for name in names)
+            keep = self.keep == "always" or not os.path.isfile(os.path.join(path, base + ".pdf"))
+            metrics.add("workspaces", file=os.path.join(workdir, filename), path=path, files=files, bytes=size, kept=keep)
+            with self.lock:
+                self.compilations += 1
+                self.written += size
+                self.largest = max(self.largest, size)
+                if keep:
+                    self.kept[path] = size
+                    while len(self.kept) > 1 and sum(self.kept.values()) > self.quota:
+                        shutil.rmtree(self.kept.popitem(last=False)[0], ignore_errors=True)
+            if not keep:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def report(self):
+        """
+        Prints the number of compilations, the volume of their intermediate files and the folders kept.
+        """
+        print(f"Scratch folders in {self.root}: {self.compilations} compilations wrote {self.written / 1e6:.1f} MB "
+              f"of files ({self.largest / 1e6:.1f} MB at most for one), "
+              f"{len(self.kept)} kept ({sum(self.kept.values()) / 1e6:.1f} MB)"
+              + (f", {self.fallbacks} moved to {tempfile.gettempdir()} for lack of space." if self.fallbacks else "."))
+        if self.kept and self.keep != "always":
+            print("\tThe folders of the failed compilations are kept:", *self.kept, sep="\n\t\t")
+
+
+# The lines of the latexmk output that start a LaTeX pass, and the LaTeX warnings
+LATEXMK_PASS = re.compile(r"Run number \d+ of rule '\w*latex'")
+LATEX_WARNING = re.compile(r"(?:LaTeX|pdfTeX|Package \S+|Class \S+)(?: Font)? Warning")
+LATEX_BOX = re.compile(r"(Overfull|Underfull) \\[hv]box \(([^)]*)\) (?:in \w+ at lines (\d+)--(\d+)|detected at line (\d+))?")
+LATEX_ERROR_LINE = re.compile(r"l\.(\d+)")
+
+
+class CompilationError(Exception):
+    """
+    Raised when latexmk could not produce the PDF of a sheet.
+    """
+
+
+def preamble_packages(source):
+    """
+    Returns the names of the packages loaded by the preamble of a LaTeX source.
+    """
+    preamble = source.split("\\begin{document}", 1)[0]
+    return {name.strip() for names in re.findall(r"\\usepackage(?:\[[^]]*\])?\{([^}]*)\}", preamble)
+            for name in names.split(",")}
+
+
+def latexmk_command(filename, fmt=None, packages=()):
+    """
+    Returns the latexmk command line compiling a source file, and the environment to run it in.
+    If fmt is a format built by preamble_format(), pdflatex loads it instead of the preamble.
+    packages are the packages loaded by the source: -shell-escape and -bibtex are only given
+    to LaTeX when one of them needs it.
+    """
+    command = ["latexmk", "-pdf"]
+    if BIBTEX_PACKAGES.intersection(packages):
+        command.append("-bibtex")
+    if SHELL_ESCAPE_PACKAGES.intersection(packages):
+        command.append("-shell-escape")
+    command.append("-interaction=nonstopmode")
+    env = None
+    if fmt is not None:
+        command.append(f"-pdflatex=pdflatex -fmt={os.path.basename(fmt)} %O %S")
+        env = dict(os.environ, TEXFORMATS=os.path.dirname(os.path.abspath(fmt)) + os.pathsep)
+    return command + [filename], env
+
+
+def latexmk_options(path, formats=None):
+    """
+    Returns the latexmk command line and environment compiling the source file at path,
+    with the precompiled format of its preamble if formats is a folder of formats.
+    """
+    with open(path) as tex:
+        source = tex.read()
+    fmt = preamble_format(source, formats) if formats is not None else None
+    return latexmk_command(os.path.basename(path), fmt, preamble_packages(source))
+
+
+def latexmk_summary(lines):
+    """
+    Reads the output of latexmk, and returns the number of LaTeX passes it ran,
+    with the number of warnings and of overfull and underfull boxes of the last pass.
+    """
+    summary = {"passes": 0, "warnings": 0, "overfull": 0, "underfull": 0}
+    for line in lines:
+        if LATEXMK_PASS.match(line):
+            summary = {"passes": summary["passes"] + 1, "warnings": 0, "overfull": 0, "underfull": 0}
+        elif LATEX_WARNING.match(line):
+            summary["warnings"] += 1
+        elif line.startswith("Overfull"):
+            summary["overfull"] += 1
+        elif line.startswith("Underfull"):
+            summary["underfull"] += 1
+    return summary
+
+
+def read_latex_log(path):
+    """
+    Reads the errors, and the overfull and underfull boxes of the last LaTeX pass, from a .log file.
+    Returns a list of {"kind": "error", "overfull" or "underfull", "lines": [first, last] or None, "detail"},
+    the lines being the lines of the source that caused it, when LaTeX tells them.
+    Overfull boxes smaller than OVERFULL_TOLERANCE are ignored.
+    """
+    problems = []
+    error = None
+    with open(path, errors="replace") as log:
+        for line in log:
+            line = line.rstrip("\n")
+            box = LATEX_BOX.match(line)
+            if line.startswith("! "):
+                error = {"kind": "error", "lines": None, "detail": line[2:]}
+                problems.append(error)
+            elif error is not None and error["lines"] is None and LATEX_ERROR_LINE.match(line):
+                number = int(LATEX_ERROR_LINE.match(line).group(1))
+                error["lines"] = [number, number]
+            elif box:
+                kind, detail, first, last, at = box.groups()
+                size = re.match(r"([\d.]+)pt too", detail)
+                if kind == "Overfull" and size and float(size.group(1)) < OVERFULL_TOLERANCE:
+                    continue
+                lines = [int(first), int(last)] if first else [int(at), int(at)] if at else None
+                problems.append({"kind": kind.lower(), "lines": lines, "detail": detail})
+    return problems
+
+
+def cacheable(pdf):
+    """
+    Tells if a compiled PDF can go to the PdfCache: its log shows no error and no overfull box.
+    The layout checks reject the other ones, and they do not run on a PDF taken from the cache.
+    """
+    log = pdf[:-len(".pdf")] + ".log"
+    return not os.path.isfile(log) or all(problem["kind"] == "underfull" for problem in read_latex_log(log))
+
+
+def run_latexmk(filename, workdir="tmp", formats=None, cache=None, metrics=NO_METRICS):
+    """
+    Runs latexmk through the system executable on one source file of workdir.
+    formats is the folder of the precompiled preambles (see preamble_format()), None to compile without.
+    If a PdfCache is given and already knows this source, the cached PDF is used and LaTeX is not run;
+    otherwise the PDF is added to the cache, unless its log shows errors or overfull boxes.
+    Raises CompilationError, with the end of the latexmk output, if the PDF has not been produced.
+    """
+    start = time.perf_counter()
+    pdf = os.path.join(workdir, filename.replace(".tex", ".pdf"))
+    if cache is not None:
+        key = cache.key(os.path.join(workdir, filename))
+        if cache.fetch(key, pdf):
+            metrics.add("compilations", file=os.path.join(workdir, filename), cached=True, ok=True,
+                        wall=time.perf_counter() - start, **latexmk_summary([]))
+            return
+
+    command, env = latexmk_options(os.path.join(workdir, filename), formats)
+    result = subprocess.run(command, cwd=workdir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            text=True, errors="replace")
+    metrics.add("compilations", file=os.path.join(workdir, filename), cached=False, ok=os.path.isfile(pdf),
+                wall=time.perf_counter() - start, **latexmk_summary(result.stdout.splitlines()))
+    if not os.path.isfile(pdf):
+        raise CompilationError(f"latexmk could not compile {filename}:\n"
+                               + "\n".join(result.stdout.splitlines()[-LATEXMK_TAIL:]))
+    if cache is not None and cacheable(pdf):
+        cache.store(key, pdf)
+
+
+async def run_latexmk_async(filename, workdir, slots, formats=None, cache=None, metrics=NO_METRICS, scratch=None):
+    """
+    Same as run_latexmk(), but from an asyncio event loop, and waiting for one of the slots
+    (an asyncio.Semaphore) to be free to start latexmk. If scratch (a Workspaces) is given,
+    latexmk runs in a private scratch folder instead of workdir.
+    The output of latexmk is read as it comes, and its end is printed if the compilation fails.
+    Returns True if the PDF has been produced.
+    """
+    import asyncio
+    start = time.perf_counter()
+    pdf = os.path.join(workdir, filename.replace(".tex", ".pdf"))
+    if cache is not None:
+        key = cache.key(os.path.join(workdir, filename))
+        if cache.fetch(key, pdf):
+            metrics.add("compilations", file=os.path.join(workdir, filename), cached=True, ok=True,
+                        wall=time.perf_counter() - start, wait=0.0, **latexmk_summary([]))
+            return True
+
+    command, env = latexmk_options(os.path.join(workdir, filename), formats)
+    output = []
+    async with slots:
+        wait = time.perf_counter() - start
+        with scratch.open(workdir, filename, metrics) if scratch is not None else contextlib.nullcontext(workdir) as cwd:
+            process = await asyncio.create_subprocess_exec(*command, cwd=cwd, env=env, stdin=asyncio.subprocess.DEVNULL,
+                                                           stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+            async for line in process.stdout:
+                output.append(line.decode("utf8", errors="replace").rstrip())
+            await process.wait()
+    metrics.add("compilations", file=os.path.join(workdir, filename), cached=False, ok=os.path.isfile(pdf),
+                wall=time.perf_counter() - start - wait, wait=wait, **latexmk_summary(output))
+
+    if not os.path.isfile(pdf):
+        print(f"latexmk could not compile {os.path.join(workdir, filename)}"
+              + (f" (in {cwd})" if cwd != workdir else "") + ":", *output[-LATEXMK_TAIL:], sep="\n\t")
+        return False
+    if cache is not None and cacheable(pdf):
+        cache.store(key, pdf)
+    return True
+
+
+def collect_pdfs(filename, workdir="tmp", outdir="pdf"):
+    """
+    Moves the compiled question and correction PDFs to the output folder.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    for pdf in (filename.replace(".tex", ".pdf"), filename.replace(".tex", "_corr.pdf")):
+        if os.path.isfile(os.path.join(workdir, pdf)):
+            shutil.move(os.path.join(workdir, pdf), os.path.join(outdir, pdf))
+
+
+async def compile_sheet_async(filename, workdir, outdir, slots, formats=None, cache=None, metrics=NO_METRICS, scratch=None):
+    """
+    Compiles the question and the correction of a sheet concurrently, then moves their PDFs to outdir.
+    Returns True if both PDFs have been produced.
+    """
+    import asyncio
+    compiled = await asyncio.gather(
+        run_latexmk_async(filename, workdir, slots, formats, cache, metrics, scratch),
+        run_latexmk_async(filename.replace(".tex", "_corr.tex"), workdir, slots, formats, cache, metrics, scratch))
+    collect_pdfs(filename, workdir, outdir)
+    return all(compiled)
+
+
+def compile_latex(filename, workdir="tmp", outdir="pdf", formats=None, cache=None, jobs=2, metrics=NO_METRICS,
+                  scratch=None):
+    """
+    Runs latexmk through the system executable, on the question and the correction at the same time.
+    """
+    import asyncio
+
+    async def compile_sheet():
+        return await compile_sheet_async(filename, workdir, outdir, asyncio.Semaphore(jobs), formats, cache, metrics,
+                                         scratch)
+
+    return asyncio.run(compile_sheet())
+
+
+def section_lines(header, sections):
+    """
+    Returns the (first, last) lines of each of the sections of a source made of header, then of the sections.
+    A section ending with a line break ends on the line before the next one starts:
+
+    >>> section_lines("header\\n", ["A\\nA\\n", "B\\nB\\n"])
+    [(2, 3), (4, 5)]
+    """
+    ranges = []
+    line = header.count("\n") + 1
+    for section in sections:
+        ranges.append((line, line + section.count("\n") - section.endswith("\n")))
+        line += section.count("\n")
+    return ranges
+
+
+def layout_problems(filename, workdir, lines, since=0):
+    """
+    Reads the problems of the LaTeX logs of a sheet written since the time since (see read_latex_log()),
+    and tells which exercice caused each of them. lines are the (first, last) lines of the exercices in the
+    question and correction sources, as returned by generate_sheet_files(). The "exercice" of a problem is
+    the position of its exercice on the sheet, or None if it comes from the header or from a page break.
+    """
+    problems = []
+    for correction, part in enumerate((filename, filename.replace(".tex", "_corr.tex"))):
+        log = os.path.join(workdir, part.replace(".tex", ".log"))
+        if not os.path.isfile(log) or os.path.getmtime(log) < since:
+            continue  # no new log, the PDF came from the cache
+        for problem in read_latex_log(log):
+            problem["file"] = part
+            problem["exercice"] = None
+            for i, (first, last) in enumerate(lines[correction] if lines is not None else []):
+                if problem["lines"] is not None and problem["lines"][0] <= last and problem["lines"][1] >= first:
+                    problem["exercice"] = i
+                    break
+            problems.append(problem)
+    return problems
+
+
+async def compile_checked_async(filename, config, workdir, outdir, slots, formats=None, cache=None,
+                                retries=RETRIES, report=None, scratch=None, lines=None):
+    """
+    Compiles a sheet whose sources are in workdir, then reads its LaTeX logs. lines are the lines of its
+    exercices in the sources, as returned by generate_sheet_files(). While an exercice causes an error
+    or an overfull box and fewer than `retries` exercices have been drawn again, imagines this exercice
+    again (the other ones are kept), writes the sources again and recompiles them.
+    Appends to report a line for each exercice drawn again, and one for the problems left, if any.
+    Returns (ok, config, sources): whether the PDFs were produced, the configuration with its redraws,
+    and the last sources, or None if they were not written again.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    report = [] if report is None else report
+    sources = None
+    retried = None
+    while True:
+        since = time.time()
+        t0 = time.perf_counter()
+        ok = await compile_sheet_async(filename, workdir, outdir, slots, formats, cache, config.metrics, scratch)
+        problems = layout_problems(filename, workdir, lines, since)
+        if retried is not None:
+            retried["seconds"] += time.perf_counter() - t0
+            report.append(retried)
+            config.metrics.add("redraws", **retried)
+        positions = sorted({p["exercice"] for p in problems if p["kind"] != "underfull" and p["exercice"] is not None})
+        positions = positions[:max(0, retries - len(config.redraws))]
+        if not positions:
+            if problems:
+                report.append({"file": os.path.join(workdir, filename), "student": config.student, "seed": config.seed,
+                               "action": "kept", "redraws": config.redraws, "problems": problems})
+            return ok, config, sources
+
+        t0 = time.perf_counter()
+        config = config.replace(redraws=config.redraws + positions)
+        sources, lines = await loop.run_in_executor(None, config.metrics.run, generate_sheet_files, filename, config,
+                                                    workdir)
+        retried = {"file": os.path.join(workdir, filename), "student": config.student, "seed": config.seed,
+                   "action": "redraw", "exercices": positions,
+                   "problems": [p for p in problems if p["exercice"] in positions],
+                   "seconds": time.perf_counter() - t0}
+
+
+def compile_checked(filename, config, workdir="tmp", outdir="pdf", formats=None, cache=None, jobs=2,
+                    retries=RETRIES, report=None, scratch=None, lines=None):
+    """
+    Same as compile_checked_async(), out of an event loop.
+    """
+    import asyncio
+
+    async def compile_sheet():
+        return await compile_checked_async(filename, config, workdir, outdir, asyncio.Semaphore(jobs), formats, cache,
+                                           retries, report, scratch, lines)
+
+    return asyncio.run(compile_sheet())
+
+
+def report_layout(report, path=None):
+    """
+    Prints a summary of the exercices drawn again because of their layout, and of the problems left,
+    and writes the whole report to a JSON file if path is given.
+    """
+    redraws = [line for line in report if line["action"] == "redraw"]
+    kept = [line for line in report if line["action"] == "kept"]
+    if redraws:
+        print(f"Layout: {sum(len(line['exercices']) for line in redraws)} exercices drawn again in "
+              f"{len({line['file'] for line in redraws})} sheets because of LaTeX errors or overfull boxes, "
+              f"in {sum(line['seconds'] for line in redraws):.2f} s.")
+    if kept:
+        kinds = collections.Counter(p["kind"] for line in kept for p in line["problems"])
+        labels = {"error": "LaTeX errors", "overfull": "overfull boxes", "underfull": "underfull boxes"}
+        print(f"Layout: {len(kept)} sheets still have " + ", ".join(f"{kinds[kind]} {label}" for kind, label in labels.items()
+                                                                  if kinds[kind]) + ".")
+    if path is not None and report:
+        write_atomic(path, json.dumps(report, indent=1, ensure_ascii=False))
+        print(f"Layout report written to {path}.")
+
+
+def sheet_packages(config):
+    """
+    Returns the packages to load for a sheet: the base packages and the ones declared by its exercices,
+    or None to load all of them when config.lean is False.
+    """
+    if not config.lean:
+        return None
+    packages = set(BASE_PACKAGES)
+    for name in config.exercices:
+        packages.update(EXERCICES[name].packages)
+    return packages
+
+
+def latex_preamble(packages=None):
+    """
+    Returns the static part of the LaTeX header, shared by all questions and corrections.
+    Only the given packages are loaded, or all the LATEX_PACKAGES if packages is None.
+    It ends with \\endofdump, where mylatexformat stops dumping the preamble into a precompiled format.
+    """
+    if packages is None:
+        packages = LATEX_PACKAGES
+    lines = [LATEX_PACKAGES[name] for name in LATEX_PACKAGES if name in packages]
+    lines += [f"\\usepackage{{{name}}}" for name in sorted(packages) if name not in LATEX_PACKAGES]
+    return """
+        \\documentclass[11pt]{article}
+        %s
+        \\providecommand{\\endofdump}{}
+        \\endofdump
+        """ % "\n        ".join(lines)
+
+
+LATEX_SPECIALS = {"\\": "\\textbackslash{}", "~": "\\textasciitilde{}", "^": "\\textasciicircum{}",
+                  **{c: "\\" + c for c in "&%$#_{}"}}
+
+
+def latex_escape(text):
+    """
+    Escapes the LaTeX special characters of a text, like a student name.
+    """
+    return re.sub(r"[\\~^&%$#_{}]", lambda match: LATEX_SPECIALS[match.group()], text)
+
+
+def sheet_titles(config, correction=False):
+    """
+    Returns the author, date and title of the question (or correction) of a sheet.
+    """
+    m = CATALOG[config.lang]["subject"]
+    title = to_l33t(config.title, config.l33t)
+    if config.student is not None:
+        title = f"{title} - {latex_escape(config.student)}"
+    if correction:
+        title = title + catalog_text("correction", config.lang, int(config.l33t > 0))
+        date = "%d-%d" % (config.year, config.year+1)
+    else:
+        date = "Generated with OpenSYE\\\\%d-%d" % (config.year, config.year+1)
+    return m, date, title
+
+
+def latex_header(config, correction=False):
+    """
+    Returns the latex code that starts the question (or correction) file of a sheet.
+    """
+    m, date, title = sheet_titles(config, correction)
+    return latex_preamble(sheet_packages(config)) + """
+        \\author{%s}
+        \\date{%s}
+        \\title{%s}
+        \\hypersetup{
+          pdfauthor={%s},
+          pdftitle={%s},
+          pdfkeywords={},
+          pdfsubject={},
+          pdfcreator={OpenSYE TD Generator Pro Plus 11 SE Max}, 
+          pdflang={French}}
+        \\begin{document}
+
+        \\maketitle
+        """ % (m, date, title, config.author, title)
+
+
+def latex_merged_header(config, correction=False):
+    """
+    Returns the latex code that starts a document merging the questions (or corrections) of several sheets.
+    It defines \\opensyetitle{author}{date}{title}, which starts a sheet on a new page with its own title,
+    and page and section numbers starting again from 1.
+    """
+    m, date, title = sheet_titles(config.replace(student=None), correction)
+    return latex_preamble(sheet_packages(config)) + """
+        \\makeatletter
+        \\AtBeginDocument{%%
+          \\let\\opensye@author\\author
+          \\let\\opensye@date\\date
+          \\let\\opensye@title\\title
+          \\let\\opensye@maketitle\\maketitle
+          \\let\\opensye@@maketitle\\@maketitle
+          \\let\\opensye@thanks\\thanks
+          \\let\\opensye@and\\and}
+        \\newcommand{\\opensyetitle}[3]{%%
+          \\clearpage
+          \\setcounter{page}{1}%%
+          \\setcounter{section}{0}%%
+          \\setcounter{footnote}{0}%%
+          \\global\\let\\@maketitle\\opensye@@maketitle
+          \\global\\let\\thanks\\opensye@thanks
+          \\global\\let\\and\\opensye@and
+          \\opensye@author{#1}\\opensye@date{#2}\\opensye@title{#3}%%
+          \\opensye@maketitle}
+        \\makeatother
+        \\hypersetup{
+          hypertexnames=false,
+          pdfauthor={%s},
+          pdftitle={%s},
+          pdfkeywords={},
+          pdfsubject={},
+          pdfcreator={OpenSYE TD Generator Pro Plus 11 SE Max}, 
+          pdflang={French}}
+        \\begin{document}
+        """ % (config.author, title)
+
+
+def latex_merged_sheet(config, sections, number, correction=False):
+    """
+    Returns the latex code of sheet number `number` in a merged document: its title, its exercices,
+    and the label opensye-end-<number>, from which read_page_counts() gets its number of pages.
+    """
+    m, date, title = sheet_titles(config, correction)
+    return """
+        \\opensyetitle{%s}{%s}{%s}
+        """ % (m, date, title) + sections + """
+        \\label{opensye-end-%d}
+        """ % number
+
+
+def latex_footer():
+    """
+    Returns the latex code that ends a file.
+    """
+    return """
+        \\end{document}
+        """
+
+
+def imagine_exercices(config, rng, verbose=False):
+    """
+    Picks config.n_exercices exercices among config.exercices and imagines them, drawing all
+    random numbers from rng. Only the classes of the picked exercices are loaded.
+    The exercices of config.redraws are then imagined again, in this order, with the next random numbers.
+    """
+    if isinstance(config.index, SheetDraws):
+        config.index.rewind()
+    exercices = [EXERCICES[name](rng, verbose, config.index, config.difficulty)
+                 for name in pick_exercices(config, rng)]
+    for exo in exercices + [exercices[i] for i in config.redraws]:
+        with config.metrics.measure("exercices", exercice=type(exo).__name__, step="imagine",
+                                    seed=config.seed, student=config.student):
+            exo.imagine(config.l33t)
+    return exercices
+
+
+def pick_exercices(config, rng):
+    """
+    Returns the names of config.n_exercices exercices drawn without replacement among config.exercices,
+    each one with a probability proportional to its weight.
+    """
+    names = list(config.exercices)
+    weights = [config.weights.get(name, 1.0) for name in names]
+    if len(set(weights)) <= 1:
+        rng.shuffle(names)
+    else:  # weighted sampling without replacement, by sorting random keys u^(1/weight)
+        keys = {name: rng.random() ** (1 / weight) for name, weight in zip(names, weights)}
+        names.sort(key=keys.get, reverse=True)
+    return names[:config.n_exercices]
+
+
+def render_exercice(exo, config, correction=False):
+    """
+    Returns the LaTeX code of the questions (or the correction) of an imagined exercice.
+    """
+    with config.metrics.measure("exercices", exercice=type(exo).__name__, step="correction" if correction else "question",
+                                seed=config.seed, student=config.student):
+        if correction:
+            return exo.correction(config.lang, config.l33t)
+        return exo.question(config.lang, config.l33t)
+
+
+def build_sheet(config, verbose=False):
+    """
+    Generates the LaTeX sources of a sheet in memory.
+    Returns the (question, correction) sources.
+    """
+    question, correction = build_sections(config, verbose)
+    return (latex_header(config) + question + latex_footer(),
+            latex_header(config, correction=True) + correction + latex_footer())
+
+
+def build_sections(config, verbose=False):
     """
-    A kind of exercice where a series of states is proposed, and the student
-    should tell if this series is realistic or obviously impossible.
+    Imagines the exercices of a sheet and returns the LaTeX code of their (questions, corrections),
+    without the header and footer of the files.
     """
+    question, correction = exercice_sections(config, verbose)
+    return "".join(question), "".join(correction)
 
-    def __init__(self):
-        self.questions = []
-        self.corrections = []
-        self.transition_map = {"E": ["P"], "P": ["X", "S"], "X": [
-            "T", "A", "P"], "S": ["P", "A"], "A": ["P", "S"], "T": []}
-        self.codes_fr = {"E": "Extérieur", "P": "Prêt", "X": "Exécution",
-                         "S": "Suspendu", "A": "Attente", "T": "Terminé"}
-        self.codes_en = {"E": "External", "P": "Ready", "X": "Execution",
-                         "S": "Suspended", "A": "Waiting", "T": "Terminated"}
 
-    def imagine(self):
-        """
-        Imagines a series of states which should be near possible.
-        """
-        n_questions = random.randint(3, 5)
-        for q in range(n_questions):
-            seq_len = random.randint(5, 8)
-            seq = ""
-            is_feasible = True
-            for state in range(seq_len):
-                newstate = ""
-                if random.random() < 0.1:
-                    # Let's do a non-feasible sequence
-                    is_feasible = False
-
-                    if state:
-                        # This is not the first state of the series, there is a previous one, seq[state-1]
-                        possibles = ['E', 'P', 'X', 'S', 'T', 'A']
-                        # remove the True solutions
-                        for x in self.transition_map[seq[state-1]]:
-                            possibles.remove(x)
-                        possibles.remove(seq[state-1])  # remove itself
-                        newstate = random.choice(possibles)
-                    else:  # This is the first state of the series. Being impossible is, being not E
-                        newstate = random.choice("PXSTA")
+def exercice_sections(config, verbose=False):
+    """
+    Same as build_sections(), but returns the lists of the questions and of the corrections of each exercice.
+    """
+    question, correction = [], []
+    for exo in imagine_exercices(config, random.Random(config.seed), verbose):
+        question.append(render_exercice(exo, config))
+        correction.append(render_exercice(exo, config, correction=True))
+    return question, correction
 
-                else:
-                    # Let's keep it feasible for now
-
-                    if state:
-                        if seq[state-1] == 'T':
-                            # the previous was T, the only possibility is to terminate early, now
-                            break
-                        possibles = self.transition_map[seq[state-1]]
-
-                        if 'T' in possibles and state == seq_len-1:
-                            # This is the last state of the sequence and we want it to be possible
-                            newstate = 'T'
-                        newstate = random.choice(possibles)
-                    else:
-                        # The only right way to start is to start by E
-                        newstate = 'E'
 
-                seq += newstate
+def write_atomic(path, text):
+    """
+    Writes a text file in one buffered write, under a temporary name first, so that the file
+    is either the previous one or the complete new one, even if the generator is interrupted.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".part")
+    try:
+        with os.fdopen(fd, "w", encoding="utf8") as f:
+            f.write(text)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
 
-            self.questions.append(seq)
-            self.corrections.append(is_feasible)
-        print("Generated a series of process states: ", "\n\t",
-              self.questions, '\n\t', self.corrections, '\n')
 
-    def question(self, LANG):
-        """
-        Generates a LaTeX states of the imagined questions.
-        """
+def generate_sheet(config, formats=None, cache=None):
+    """
+    Generates and compiles a sheet, without touching any global state or the current directory,
+    so that it can be called from several threads at once.
+    formats and cache are an optional folder of precompiled preambles (see preamble_format()) and PdfCache.
+    Returns the (question, correction) PDFs as bytes, or raises CompilationError.
+    """
+    question, correction = build_sheet(config)
+    pdfs = []
+    with tempfile.TemporaryDirectory(prefix="opensye-") as workdir:
+        for name, source in (("sheet.tex", question), ("sheet_corr.tex", correction)):
+            with open(os.path.join(workdir, name), "w") as tex:
+                tex.write(source)
+            run_latexmk(name, workdir, formats, cache, config.metrics)
+            with open(os.path.join(workdir, name.replace(".tex", ".pdf")), "rb") as pdf:
+                pdfs.append(pdf.read())
+    return pdfs[0], pdfs[1]
 
-        if "FR" in LANG:
-            guidelines = "\\section{Suite d'états de processus}\n\n"
-            guidelines += "Les processus dans un système d’exploitation ont très souvent un état. "
-            guidelines += "Définissez l’état d’un processus et expliquez son utilité. "
-            guidelines += "Rappelez le schéma des transitions entre états qu’un processus peut subir (son cycle de vie) et expliquez chaque transition.\n"
-            guidelines += "Pour chaque suite d'états dans la liste suivante, indiquez si elle est possible ou non et argumentez votre réponse. \n\n"""
-            state_map = self.codes_fr
-        if "EN" in LANG:
-            guidelines = "\\section{Process states series}\n\n"
-            guidelines += "Processes in an operating system are almost often described by a state. "
-            guidelines += "Define what is a process state and explain its uses. "
-            guidelines += "Draw the possible relations of transition between the states (the proces life cycle) and explain each of the transitions.\n"
-            guidelines += "For each series of states in the following list, indicate if it is likely to occur in real life or not, and argue. \n\n"""
-            state_map = self.codes_en
-        guidelines = to_l33t(guidelines, int(L33TLVL > 0))
 
-        spacer = ' $\\rightarrow$ '
-        for i in range(len(self.questions)):
-            state_path = [state_map[state] for state in self.questions[i]]
-            guidelines += f'{i+1}. {(spacer).join(state_path)}\n\n'
+# Text renderers: the sheets as HTML, Markdown, JSON or Moodle XML, from the content() of the exercices,
+# without LaTeX.
 
-        return guidelines
+LATEX_INLINE = re.compile(r"\\textbf\{([^}]*)\}|\\textit\{([^}]*)\}|\$([^$]*)\$")
 
-    def correction(self, LANG):
-        """
-        Generates a LaTeX states of the correction of the imagined questions.
-        """
-        if "FR" == LANG:
-            answer = "\\section{Suite d'états de processus}\n\n"
-            answer += "Voici les réponses pour l'exercice Suite des états de processus.\n\n"
-            for i, v in enumerate(self.corrections):
-                if v:
-                    answer += f"{i+1}. Cette suite d'états de processus était correcte.\n\n"
-                else:
-                    answer += f"{i+1}. Cette suite d'états de processus était fausse. "
-                    answer += self.get_wrong_transitions(self.questions[i])
-                    answer += "\n\n"
-
-        if "EN" == LANG:
-            answer = "\\section{Process states series}\n\n"
-            answer += "Here are the answers for the Process states series exercice.\n\n"
-            for i, v in enumerate(self.corrections):
-                if v:
-                    answer += f"{i+1}. This series of process states was correct.\n\n"
-                else:
-                    answer += f"{i+1}. This series of process states was wrong. "
-                    answer += self.get_wrong_transitions(self.questions[i])
-                    answer += "\n\n"
 
-        return to_l33t(answer, int(L33TLVL > 0))
+def latex_blocks(latex):
+    """
+    Converts the small subset of LaTeX used by the exercices (a section, paragraphs, \\textbf, \\textit, math and
+    verbatim blocks) to structured content. Returns the title of the section (or None), and a list of blocks:
+    ("code", text), or ("p", runs) where runs is a list of (style, text) with style None, "b", "i" or "math".
+    """
+    title = None
+    section = re.search(r"\\section\{([^}]*)\}", latex)
+    if section is not None:
+        title = section.group(1)
+        latex = latex[:section.start()] + latex[section.end():]
+
+    blocks = []
+    parts = re.split(r"\\begin\{verbatim\}\n?(.*?)\\end\{verbatim\}", latex, flags=re.DOTALL)
+    for i, part in enumerate(parts):
+        if i % 2:
+            blocks.append(("code", textwrap.dedent(part).strip("\n")))
+            continue
+        # \\ and a final \ are line breaks, that end a paragraph here
+        part = part.replace("\\\\", "\n\n").replace("\\\n", "\n\n").replace("\\noindent", "").replace("~", " ")
+        for paragraph in re.split(r"\n\s*\n", part):
+            paragraph = " ".join(paragraph.split())
+            if paragraph:
+                blocks.append(("p", latex_runs(paragraph)))
+    return title, blocks
+
+
+def latex_runs(text):
+    """
+    Splits a paragraph of LaTeX into (style, text) runs, see latex_blocks().
+    """
+    runs = []
+    pos = 0
+    for match in LATEX_INLINE.finditer(text):
+        if match.start() > pos:
+            runs.append((None, latex_unescape(text[pos:match.start()])))
+        bold, italic, math = match.groups()
+        if bold is not None:
+            runs.append(("b", latex_unescape(bold)))
+        elif italic is not None:
+            runs.append(("i", latex_unescape(italic)))
+        else:
+            runs.append(("math", re.sub(r"_\{?(\w+)\}?", r"\1", math)))
+        pos = match.end()
+    if pos < len(text):
+        runs.append((None, latex_unescape(text[pos:])))
+    return runs
+
+
+def latex_unescape(text):
+    """
+    Replaces the escaped LaTeX special characters by the characters themselves.
+    """
+    return re.sub(r"\\([%&_#$])", r"\1", text)
 
-    def get_wrong_transitions(self, seq):
-        """
-        Identifies bad transitions in a sequence and output LaTeX code to explain why it is wrong.
-        """
-        answer = ""
-        for i in range(len(seq)-1):
-            if seq[i+1] not in self.transition_map[seq[i]]:
-                if LANG == "FR":
-                    answer += f"La transition {self.code_to_word(seq[i])} vers {self.code_to_word(seq[i+1])} est impossible. "
-                if LANG == "EN":
-                    answer += f"The transition {self.code_to_word(seq[i])} towards {self.code_to_word(seq[i+1])} is not possible. "
 
-        return answer
+def plain_title(config, correction=False):
+    """
+    Returns the title of a sheet as plain text (see sheet_titles() for LaTeX).
+    """
+    title = to_l33t(config.title, config.l33t).replace("\\%", "%").replace("\\\\", "\\")
+    if config.student is not None:
+        title = f"{title} - {config.student}"
+    if correction:
+        title += to_l33t(" (Correction)", int(config.l33t > 0))
+    return title
 
-    def code_to_word(self, code):
-        if LANG == "FR":
-            return self.codes_fr[code]
 
-        if LANG == "EN":
-            return self.codes_en[code]
+class HtmlRenderer:
+    """
+    Renders sheets as a standalone HTML page, one <article> per sheet.
+    The questions and the corrections are rendered in two files.
+    """
 
+    extension = ".html"
+    split = True  # the corrections go in their own file
 
-class RunningTreeExercice:
+    def __init__(self, correction=False):
+        self.correction = correction
+
+    def runs(self, runs):
+        import html
+
+        tags = {"b": "strong", "i": "em", "math": "var"}
+        return "".join(html.escape(text) if style is None else f"<{tags[style]}>{html.escape(text)}</{tags[style]}>"
+                       for style, text in runs)
+
+    def blocks(self, blocks):
+        import html
+
+        return "".join(f"<p>{self.runs(block)}</p>\n" if kind == "p" else f"<pre>{html.escape(block)}</pre>\n"
+                       for kind, block in blocks)
+
+    def begin(self, config):
+        import html
+
+        title = html.escape(plain_title(config.replace(student=None), self.correction))
+        return (f'<!DOCTYPE html>\n<html lang="{config.lang.lower()}">\n<head>\n<meta charset="utf-8">\n'
+                f"<title>{title}</title>\n</head>\n<body>\n")
+
+    def sheet(self, config, contents):
+        import html
+
+        out = [f'<article id="sheet-{config.seed}">\n<h1>{html.escape(plain_title(config, self.correction))}</h1>\n']
+        for content in contents:
+            out.append(f"<section>\n<h2>{html.escape(content['title'])}</h2>\n")
+            if not self.correction:
+                out.append(self.blocks(content["statement"]))
+            for part in content["parts"]:
+                if not self.correction:
+                    out.append(self.blocks(part["intro"]))
+                out.append("<ol>\n")
+                for q in part["questions"]:
+                    out.append(f'<li value="{q["number"]}">\n{self.blocks(q["answer" if self.correction else "prompt"])}</li>\n')
+                out.append("</ol>\n")
+            out.append("</section>\n")
+        out.append("</article>\n")
+        return "".join(out)
+
+    def end(self):
+        return "</body>\n</html>\n"
+
+
+class MarkdownRenderer:
     """
-    An exercice to train the student to convert formulations of composed groups
-    of tasks between the operator || formulation and the 'parbegin' pseudocode.
+    Renders sheets as Markdown, one top-level title per sheet.
+    The questions and the corrections are rendered in two files.
     """
 
-    def __init__(self):
-        self.questions = []
-        self.corrections = []
-        self.rev_questions = []
-        self.rev_corrections = []
+    extension = ".md"
+    split = True
 
-    def imagine(self):
-        def expand(n, c, indent_level):
-            s = ""
-            r = ""
-
-            brackets = (c > 1)
-            if brackets:
-                s += '('
-            for m in range(indent_level):
-                r += '\t'
-            r += "parbegin\n"
-            indent_level += 1
-
-            # Iterate on the parallel groups
-            for i in range(n):
-                # tirer k étapes séquentielles à réaliser pour le ième groupe parallèle
-                # randint(1,3) mais avec plus souvent des 1 que des 3
-                k = 1+int(random.randint(1, 6)/3.0)
-
-                if k > 1:
-                    for m in range(indent_level):
-                        r += '\t'
-                    r += "begin\n"
-                    indent_level += 1
-                    s += '('
-
-                for j in range(k):
-                    if random.random() > 0.12:
-                        s += f"T{c}"
-                        for m in range(indent_level):
-                            r += '\t'
-                        r += f"T{c};\n"
-                        c += 1
-                    else:  # tirer à nouveau l choses parallèles pour le jième groupe séquentiel
-                        l = random.randint(2, 3)
-                        news, c, newr = expand(l, c, indent_level)
-                        s += news
-                        r += newr
-
-                if k > 1:
-                    indent_level -= 1
-                    for m in range(indent_level):
-                        r += '\t'
-                    r += "end;\n"
-                    s += ')'
-
-                s += "||"
-
-            indent_level -= 1
-            for m in range(indent_level):
-                r += '\t'
-            r += "parend;\n"
-
-            if brackets:
-                return (s[:-2]+')', c, r)
-            return (s[:-2], c, r)
-
-        n_questions = random.randint(3, 5)
-        tasks = []
-        sols = []
-        for _ in range(n_questions):
-            seq_len = random.randint(1, 3)
-            s, _, r = expand(seq_len, 1, 0)
-            tasks.append(s)
-            sols.append("begin\n"+r+"end;")
-        self.questions = tasks
-        self.corrections = sols
-        print(to_l33t("Generating a series of composed tasks: ",
-                      int(L33TLVL > 0)), '\n\t', self.questions, '\n')
-
-        n_questions = random.randint(1, 2)
-        tasks = []
-        sols = []
-        for _ in range(n_questions):
-            seq_len = random.randint(1, 3)
-            s, _, r = expand(seq_len, 1, 0)
-            tasks.append(s)
-            sols.append("begin\n"+r+"end;")
-        self.rev_questions = sols
-        self.rev_corrections = tasks
-        print(to_l33t("Generating a second series of composed tasks to find: ", int(
-            L33TLVL > 0)), '\n\t', self.questions, '\n')
-
-    def question(self, LANG):
-        """
-        Generates a LaTeX states of the imagined questions.
-        """
+    def __init__(self, correction=False):
+        self.correction = correction
 
-        if "FR" in LANG:
-            guidelines = """
-            \\section{Ecriture de programmes parallèles}
+    def text(self, text):
+        return re.sub(r"([\\`*_\[\]<#])", r"\\\1", text)
 
-            La plupart des librairies de programmation parallèle fournissent des primitives réalisant la \\textit{composition parallèle} : la mise en parallèle de plusieurs tâches.
-            Le paradigme de programmation impérative fournit à son tour la composition séquentielle : l'exécution de plusieurs tâches l'une à la suite de l'autre.\\
+    def runs(self, runs):
+        marks = {None: "", "b": "**", "i": "*", "math": "`"}
+        return "".join(marks[style] + (text if style == "math" else self.text(text)) + marks[style] for style, text in runs)
 
-            La composition parallèle est souvent écrite en utilisant le symbole ||, alors que la composition séquentielle est notée en juxtaposant les tâches. Par exemple, $(T_1||T_2)T_3$ exprime la composition 
-            parallèle des tâches $T_1$ et $T_2$, et ensuite la composition séquentielle du résultat avec la tâche $T_3$.\\
+    def blocks(self, blocks):
+        return "".join(f"{self.runs(block)}\n\n" if kind == "p" else f"```\n{block}\n```\n\n" for kind, block in blocks)
 
-            Cependant, lorsqu'on souhaite décrire dans un pseudocode le contenu de tâches composées, il est plus pratique d'utiliser des constructions \\textbf{parbegin / parend} pour la composition parallèle et \\textbf{begin/end} pour la composition
-            séquentielle. L'exemple précédent s'exprimerait avec ces constructions comme ceci:\\
-            \\begin{verbatim}
-            begin
-                parbegin
-                    T1;
-                    T2;
-                parend;
-                T3;
-            end;
-            \\end{verbatim}
+    def begin(self, config):
+        return ""
 
-            Ecrivez les expressions suivantes avec les constructions \\textbf{parbegin / parend} et \\textbf{begin / end} :\\\\
-            """
+    def sheet(self, config, contents):
+        out = [f"# {self.text(plain_title(config, self.correction))}\n\n"]
+        for content in contents:
+            out.append(f"## {self.text(content['title'])}\n\n")
+            if not self.correction:
+                out.append(self.blocks(content["statement"]))
+            for part in content["parts"]:
+                if not self.correction:
+                    out.append(self.blocks(part["intro"]))
+                for q in part["questions"]:
+                    blocks = q["answer" if self.correction else "prompt"]
+                    out.append(f"**{q['number']}.**" + (" " if blocks[0][0] == "p" else "\n\n") + self.blocks(blocks))
+        return "".join(out)
 
-        if "EN" in LANG:
-            guidelines = """
-            \\section{Write parallel programs}
+    def end(self):
+        return ""
 
-            Most of the parallel programming libraries provide templates implementing the \\textit{parallel composition} : the side-by-side execution of several tasks.
-            The imperative programming paradigm also provides the sequential composition : execution of tasks successively, each after the previous one.\\
 
-            The parallel composition is often written using the || symbol, while the sequential composition is written by putting tasks next to each other. As an example, $(T_1||T_2)T_3$ describes the parallel composition 
-            of tasks $T_1$ et $T_2$, and then the sequential composition of the result with task $T_3$.\\
+class JsonRenderer:
+    """
+    Renders sheets as a JSON array, one object per sheet with its questions and their answers.
+    Paragraphs are lists of {"style", "text"} runs, and code blocks strings.
+    """
 
-            However, when one wants to describe in pseudocode an ensemble of composed tasks, it is more convenient to use \\textbf{parbegin / parend} keywords for the parallel comparison, 
-            and \\textbf{begin/end} for sequential composition. The previous example would be expressed using these constructions in the following way:\\\\
-            \\begin{verbatim}
-            begin
-                parbegin
-                    T1;
-                    T2;
-                parend;
-                T3;
-            end;
-            \\end{verbatim}
+    extension = ".json"
+    split = False  # the answers are in the same file
 
-            Write the following expressions using the \\textbf{parbegin / parend} and \\textbf{begin / end} formulations:\\\\
-            """
-        guidelines = to_l33t(guidelines, int(L33TLVL > 0))
+    def __init__(self, correction=False):
+        self.first = True
 
-        for i, v in enumerate(self.questions):
-            guidelines += f"{i+1}. " + v + "\\\\\n"
+    def blocks(self, blocks):
+        return [{"code": block} if kind == "code" else {"paragraph": [{"style": style, "text": text} for style, text in block]}
+                for kind, block in blocks]
 
-        if LANG == "FR":
-            if len(self.rev_questions) == 1:
-                guidelines += to_l33t(
-                    "\nA l'inverse, convertissez ce pseudo-code en formulation compacte à l'aide des opérateurs ||: \\\\", int(L33TLVL > 0))
-            else:
-                guidelines += to_l33t(
-                    "\nA l'inverse, convertissez ces pseudo-codes en formulation compacte à l'aide des opérateurs ||: \\\\", int(L33TLVL > 0))
+    def begin(self, config):
+        return "[\n"
 
-        if LANG == "EN":
-            if len(self.rev_questions) == 1:
-                guidelines += to_l33t(
-                    "\nOn the opposite, convert this pseudocode into a compact formulation using the || operator: \\\\", int(L33TLVL > 0))
-            else:
-                guidelines += to_l33t(
-                    "\nOn the opposite, convert these pseudocodes into compact formulations using the || operator: \\\\", int(L33TLVL > 0))
+    def sheet(self, config, contents):
+        sheet = {
+            "student": config.student, "seed": config.seed, "lang": config.lang, "l33t": config.l33t,
+            "title": plain_title(config),
+            "exercices": [{
+                "exercice": content["exercice"], "title": content["title"],
+                "statement": self.blocks(content["statement"]),
+                "parts": [{"intro": self.blocks(part["intro"]),
+                           "questions": [dict(q, prompt=self.blocks(q["prompt"]), answer=self.blocks(q["answer"]))
+                                         for q in part["questions"]]}
+                          for part in content["parts"]]}
+                for content in contents]}
+        separator = "" if self.first else ",\n"
+        self.first = False
+        return separator + json.dumps(sheet, ensure_ascii=False)
 
-        for i, v in enumerate(self.rev_questions):
-            guidelines += f"{i+len(self.questions)+1}" + r". \\" + '\n' + r"\begin{verbatim}" + \
-                '\n' + v.replace('\t', "    ") + '\n' + \
-                r"\end{verbatim}" + "\n~\\\\\n"
+    def end(self):
+        return "\n]\n"
 
-        return guidelines
 
-    def correction(self, LANG):
-        """
-        Generates a LaTeX states of the correction of the imagined questions.
-        """
+class MoodleRenderer(HtmlRenderer):
+    """
+    Renders sheets as Moodle XML questions, to import in a question bank: one category per sheet,
+    true/false questions for the series of states, and essay questions (with the answer for the grader)
+    for the compositions of tasks.
+    """
 
-        answer = ""
-        if "FR" == LANG:
-            answer += to_l33t(
-                "\\section{Ecriture de programmes parallèles}\n\n", int(L33TLVL > 0))
-            answer += to_l33t(
-                "Voici les réponses pour l'exercice Ecriture de programmes parallèles.\n\n", int(L33TLVL > 0))
-
-        if "EN" == LANG:
-            answer += to_l33t("\\section{Write parallel programs}\n\n",
-                              int(L33TLVL > 0))
-            answer += to_l33t(
-                "Here are the answers for exercice Write parallel programs.\n\n", int(L33TLVL > 0))
+    extension = ".xml"
+    split = False
+
+    def cdata(self, text):
+        return "<![CDATA[" + text.replace("]]>", "]]]]><![CDATA[>") + "]]>"
+
+    def begin(self, config):
+        return '<?xml version="1.0" encoding="UTF-8"?>\n<quiz>\n'
+
+    def sheet(self, config, contents):
+        import html
+
+        category = "$course$/top/OpenSYE/" + "/".join(
+            html.escape(t.replace("/", "-"), quote=False)
+            for t in (plain_title(config.replace(student=None)), config.student or f"seed {config.seed}"))
+        out = [f'<question type="category">\n<category><text>{category}</text></category>\n</question>\n']
+        for content in contents:
+            for part in content["parts"]:
+                statement = self.blocks(content["statement"] + part["intro"])
+                for q in part["questions"]:
+                    name = html.escape(f"{content['title']} {q['number']}", quote=False)
+                    text = self.cdata(statement + self.blocks(q["prompt"]))
+                    answer = self.cdata(self.blocks(q["answer"]))
+                    out.append(f'<question type="{q["kind"]}">\n<name><text>{name}</text></name>\n'
+                               f'<questiontext format="html"><text>{text}</text></questiontext>\n'
+                               f'<generalfeedback format="html"><text>{answer}</text></generalfeedback>\n'
+                               "<defaultgrade>1</defaultgrade>\n<hidden>0</hidden>\n")
+                    if q["kind"] == "truefalse":
+                        for value in (True, False):
+                            fraction = 100 if value == q["truth"] else 0
+                            out.append(f'<answer fraction="{fraction}" format="moodle_auto_format">'
+                                       f"<text>{str(value).lower()}</text>"
+                                       f'<feedback format="html"><text>{answer}</text></feedback></answer>\n')
+                        out.append("<penalty>1</penalty>\n")
+                    else:
+                        out.append('<penalty>0</penalty>\n<responseformat>monospaced</responseformat>\n'
+                                   "<responserequired>1</responserequired>\n<responsefieldlines>15</responsefieldlines>\n"
+                                   "<attachments>0</attachments>\n"
+                                   f'<graderinfo format="html"><text>{answer}</text></graderinfo>\n'
+                                   '<responsetemplate format="html"><text></text></responsetemplate>\n')
+                    out.append("</question>\n")
+        return "".join(out)
 
-        for i, v in enumerate(self.corrections):
-            answer += f"{i+1}" + r". \\" + '\n' + r"\begin{verbatim}" + \
-                '\n' + v.replace('\t', "    ") + '\n' + \
-                r"\end{verbatim}" + "\n\n"
-        for i, v in enumerate(self.rev_corrections):
-            answer += f"\\noindent {i+len(self.corrections)+1}. " + \
-                v + "\\\\\n"
+    def end(self):
+        return "</quiz>\n"
 
-        return answer
 
+RENDERERS = {"html": HtmlRenderer, "markdown": MarkdownRenderer, "json": JsonRenderer, "moodle": MoodleRenderer}
 
-leet_level_1 = {
-    "a": "4", "b": "6", "l": "|", "o": "0", "e": "3", "t": "7", "s": "5", "i": "1"
-}
-leet_level_2 = {
-    "a": "4", "b": "6", "l": "1", "o": "0", "e": "3", "t": "7",
-    "c": "(", "d": "[)", "f": "|=", "h": "#", "i": "!", "j": ",|", "k": "]{", "m": "(\\\\/)", "n": "(\\\\)", "s": "5", "u": "(_)", "v": "\\\\/", "w": "'//", "x": "\\%", "y": "'/"
-}
-leet_level_3 = {
-    "a": "/-\\\\", "b": "!3", "c": "(", "d": "|)", "e": "3", "f": "|=", "g": "(_+", "h": "]-[", "i": "!", "j": "_|", "k": "|<", "l": "|_", "m": "|\\\\/|", "n": "/\\\\/", "o": "()", "p": "|*",
-    "q": "0_", "r": "|?", "s": "5", "t": "7", "u": "|_|", "v": "\\\\/", "w": "\\\\/\\\\/", "x": "><", "y": "'/", "z": "2"
-}
 
+def render_sheets(filename, config, students, fmt, outdir="out"):
+    """
+    Renders the sheets of the students (or a single sheet if students is empty) in one of the RENDERERS formats,
+    streamed sheet after sheet into one file, and into a second one for the corrections if the format separates them.
+    Sheet number i is generated with seed config.seed+i, as with generate_cohort().
+    The files are only put in place once complete. Returns their paths.
+    """
+    renderer_class = RENDERERS[fmt]
+    os.makedirs(outdir, exist_ok=True)
+    outputs = [(False, os.path.join(outdir, filename.replace(".tex", renderer_class.extension)))]
+    if renderer_class.split:
+        outputs.append((True, os.path.join(outdir, filename.replace(".tex", "_corr" + renderer_class.extension))))
 
-def compile_latex(filename):
+    streams = []
+    try:
+        with contextlib.ExitStack() as stack:
+            for correction, path in outputs:
+                fd, tmp = tempfile.mkstemp(dir=outdir, suffix=".part")
+                streams.append((stack.enter_context(os.fdopen(fd, "w", encoding="utf8")), renderer_class(correction), tmp))
+            for out, renderer, _ in streams:
+                out.write(renderer.begin(config))
+            for i, student in enumerate(students or [None]):
+                sheet = config.replace(seed=config.seed + i, student=student)
+                contents = [exo.content(sheet.lang, sheet.l33t) for exo in imagine_exercices(sheet, random.Random(sheet.seed))]
+                for out, renderer, _ in streams:
+                    out.write(renderer.sheet(sheet, contents))
+            for out, renderer, _ in streams:
+                out.write(renderer.end())
+    except BaseException:
+        for _, _, tmp in streams:
+            os.unlink(tmp)
+        raise
+    for (_, path), (_, _, tmp) in zip(outputs, streams):
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    return [path for _, path in outputs]
+
+
+def clean_outputs(filename, workdir="tmp", outdir="pdf"):
     """
-    Runs latexmk through the system executable.
+    Creates the working and output folders, and removes the PDFs left by a previous run.
+    The sources do not need to be removed, they are replaced at once by generate_sheet_files().
     """
-    os.chdir("tmp")
-    subprocess.run(["latexmk", "-pdf", "-bibtex",
-                    "-shell-escape", filename], capture_output=True)
-    subprocess.run(["latexmk", "-pdf", "-bibtex", "-shell-escape",
-                    filename.replace(".tex", "_corr.tex")], capture_output=True)
-    os.chdir("..")
-    subprocess.run(["mv", "tmp/"+filename.replace(".tex", ".pdf"), "pdf"])
-    subprocess.run(["mv", "tmp/"+filename.replace(".tex", "_corr.pdf"), "pdf"])
+    os.makedirs(workdir, exist_ok=True)
+    os.makedirs(outdir, exist_ok=True)
+    for pdf in (filename.replace(".tex", ".pdf"), filename.replace(".tex", "_corr.pdf")):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(outdir, pdf))
 
 
-def generate_latex_header(filename, title):
+def generate_sheet_files(filename, config, workdir="tmp"):
+    """
+    Imagines the exercices of a sheet and writes the question and correction sources in workdir.
+    The sheet is reproducible if config.seed is set. Returns the (question, correction) sources,
+    and the (first, last) lines of each exercice in the (question, correction) sources.
+    """
+    sources, lines = [], []
+    for correction, sections in enumerate(exercice_sections(config, verbose=True)):
+        header = latex_header(config, bool(correction))
+        sources.append(header + "".join(sections) + latex_footer())
+        lines.append(section_lines(header, sections))
+    with config.metrics.measure("writes", file=os.path.join(workdir, filename)):
+        write_atomic(os.path.join(workdir, filename), sources[0])
+        write_atomic(os.path.join(workdir, filename.replace(".tex", "_corr.tex")), sources[1])
+    return tuple(sources), tuple(lines)
+
+
+def generate_student_sheet(filename, config, workdir, outdir):
     """
-    Append the latex code that starts a file.
+    Cleans the folders of a student and writes the sources of its sheet.
+    Returns its sources and the lines of its exercices (see generate_sheet_files()).
     """
-    if LANG == "FR":
-        m = "Systèmes d'exploitation (SYE)"
-    elif LANG == "EN":
-        m = "Operating Systems"
-    correction = filename.replace(".tex", "_corr.tex")
+    with config.metrics.phase("generation"):
+        clean_outputs(filename, workdir, outdir)
+        return generate_sheet_files(filename, config, workdir)
 
-    with open("tmp/"+filename, "a") as tex:
-        tex.write("""
-        \\documentclass[11pt]{article}
-        \\usepackage[T1]{fontenc}
-        \\usepackage{graphicx}
-        \\usepackage{grffile}
-        \\usepackage{longtable}
-        \\usepackage{wrapfig}
-        \\usepackage{rotating}
-        \\usepackage[normalem]{ulem}
-        \\usepackage{amsmath}
-        \\usepackage{textcomp}
-        \\usepackage{amssymb}
-        \\usepackage{capt-of}
-        \\usepackage{hyperref}
-        \\usepackage{minted}
-        \\usepackage{tabularx}
-        \\usepackage[french]{babel}
-        \\usepackage[text={17cm,24cm},centering]{geometry}
-        \\usepackage{enumitem}
-        \\usepackage{tikz}
-        \\usetikzlibrary{positioning,arrows.meta}
-        \\author{%s}
-        \\date{Generated with OpenSYE\\\\%d-%d}
-        \\title{%s}
-        \\hypersetup{
-          pdfauthor={%s},
-          pdftitle={%s},
-          pdfkeywords={},
-          pdfsubject={},
-          pdfcreator={OpenSYE TD Generator Pro Plus 11 SE Max}, 
-          pdflang={French}}
-        \\begin{document}
 
-        \\maketitle
-        """ % (m, YEAR, YEAR+1, title, AUTHOR, title))
+def read_roster(path):
+    """
+    Reads a roster file, one student per line. Empty lines and lines starting with # are ignored.
+    """
+    with open(path) as roster:
+        return [line.strip() for line in roster if line.strip() and not line.startswith("#")]
 
-    title = title + to_l33t(" (Correction)", int(L33TLVL > 0))
-    with open("tmp/"+correction, "a") as corr:
-        corr.write("""
-        \\documentclass[11pt]{article}
-        \\usepackage[T1]{fontenc}
-        \\usepackage{graphicx}
-        \\usepackage{grffile}
-        \\usepackage{longtable}
-        \\usepackage{wrapfig}
-        \\usepackage{rotating}
-        \\usepackage[normalem]{ulem}
-        \\usepackage{amsmath}
-        \\usepackage{textcomp}
-        \\usepackage{amssymb}
-        \\usepackage{capt-of}
-        \\usepackage{hyperref}
-        \\usepackage{minted}
-        \\usepackage{tabularx}
-        \\usepackage[french]{babel}
-        \\usepackage[text={17cm,24cm},centering]{geometry}
-        \\usepackage{enumitem}
-        \\usepackage{tikz}
-        \\usetikzlibrary{positioning,arrows.meta}
-        \\author{%s}
-        \\date{%d-%d}
-        \\title{%s}
-        \\hypersetup{
-          pdfauthor={%s},
-          pdftitle={%s},
-          pdfkeywords={},
-          pdfsubject={},
-          pdfcreator={OpenSYE TD Generator Pro Plus 11 SE Max}, 
-          pdflang={French}}
-        \\begin{document}
 
-        \\maketitle
-        """ % (m, YEAR, YEAR+1, title, AUTHOR, title))
+def student_dirname(name):
+    """
+    Converts a student name to something usable as a folder name.
+    """
+    return re.sub(r"[^\w.-]+", "_", name).strip("_") or "student"
 
 
-def generate_exercice(filename, exo):
+def student_dirnames(students):
     """
-    Append the latex code that ends a file.
+    Gives each student a distinct folder name, even if two of them share the same name.
     """
-    correction = filename.replace(".tex", "_corr.tex")
+    dirnames = []
+    for name in students:
+        d = student_dirname(name)
+        while d in dirnames:
+            d += "_"
+        dirnames.append(d)
+    return dirnames
 
-    with open("tmp/"+filename, "a") as tex:
-        tex.write(exo.question(LANG))
 
-    with open("tmp/"+correction, "a") as corr:
-        corr.write(exo.correction(LANG))
+class Manifest:
+    """
+    The record of a cohort run, in JSON Lines: one line per sheet, appended as soon as the sheet is compiled,
+    with its seed and parameters, the SHA-256 of its sources and whether its PDFs were produced.
+    Any sheet can be generated again from its line, and an interrupted run can be resumed by skipping
+    the sheets already done. Lines cut by a crash are ignored, and the last line of a sheet wins.
+    """
+
+    # The SheetConfig parameters that determine a sheet (besides its draws from the UniquenessIndex, if any)
+    fields = ("student", "seed", "lang", "l33t", "year", "title", "author", "exercices", "weights",
+              "n_exercices", "difficulty", "lean")
+
+    def __init__(self, path, load=True):
+        self.path = path
+        self.entries = {}  # by sheet number
+        if not load:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            open(path, "w").close()
+        elif os.path.isfile(path):
+            with open(path, encoding="utf8") as f:
+                lines = f.readlines()
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.entries[entry["index"]] = entry
+            if lines and not lines[-1].endswith("\n"):  # end the cut line, so that the next one is not lost
+                with open(path, "a", encoding="utf8") as f:
+                    f.write("\n")
+
+    @classmethod
+    def params(cls, config):
+        return {field: getattr(config, field) for field in cls.fields}
+
+    @staticmethod
+    def reproducible(entry):
+        """
+        Tells if the sheet of a line can be imagined again: the lines written before the draws from
+        the UniquenessIndex were recorded cannot, if the sheet used one.
+        """
+        return not entry.get("unique") or "rejections" in entry
+
+    @classmethod
+    def sheet_config(cls, config, entry, index=None):
+        """
+        Returns the configuration of the sheet of a line: config with the parameters, the redraws and the draws
+        from the UniquenessIndex it records. The draws beyond the recorded ones are checked against index, if given.
+        Raises ValueError if the sheet cannot be imagined again.
+        """
+        if not cls.reproducible(entry):
+            raise ValueError(f"The sheet of {entry['student']} (seed {entry['seed']}) used a uniqueness index, "
+                             "but its draws are not recorded: it cannot be generated again.")
+        index = SheetDraws(index, entry["rejections"]) if entry.get("unique") else None
+        return config.replace(redraws=entry.get("redraws", []), index=index,
+                              **{field: entry[field] for field in cls.fields})
+
+    def done(self, index, config, pdfs):
+        """
+        Tells if sheet number index has already been produced with this configuration, and its PDFs are still there.
+        """
+        entry = self.entries.get(index)
+        return (entry is not None and entry["status"] == "ok"
+                and all(entry.get(field) == value for field, value in self.params(config).items())
+                and all(os.path.isfile(pdf) for pdf in pdfs))
+
+    def record(self, index, config, dirname, sources, ok, pdfs):
+        """
+        Appends the line of a sheet, and flushes it to the disk.
+        """
+        entry = {"index": index, **self.params(config), "dir": dirname,
+                 "tex": {part: hashlib.sha256(source.encode("utf8")).hexdigest()
+                         for part, source in zip(("question", "correction"), sources)},
+                 "status": "ok" if ok else "failed", "pdfs": pdfs if ok else [],
+                 "redraws": config.redraws, "finished": time.strftime("%Y-%m-%d %H:%M:%S"),
+                 "unique": config.index is not None}
+        if isinstance(config.index, SheetDraws):
+            entry["rejections"] = config.index.rejections
+        with open(self.path, "a", encoding="utf8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries[index] = entry
+
+    def find(self, student):
+        """
+        Returns the last line of a student (or of a sheet number), or None.
+        """
+        for index, entry in sorted(self.entries.items()):
+            if entry["student"] == student or str(index) == student:
+                return entry
+        return None
 
 
-def generate_latex_footer(filename):
+def sheet_pdfs(filename, outdir):
     """
-    Append the latex code that ends a file.
+    Returns the paths of the question and correction PDFs of a sheet.
     """
-    correction = filename.replace(".tex", "_corr.tex")
+    return [os.path.join(outdir, filename.replace(".tex", ".pdf")), os.path.join(outdir, filename.replace(".tex", "_corr.pdf"))]
 
-    with open("tmp/"+filename, "a") as tex:
-        tex.write("""
-        \\end{document}
-        """)
-    with open("tmp/"+correction, "a") as corr:
-        corr.write("""
-        \\end{document}
-        """)
+
+def replay_sheet(filename, config, entry, formats=None, cache=None, scratch=None):
+    """
+    Generates again the sheet of a manifest line in tmp/<student>/ and pdf/<student>/, with the parameters
+    and the exercices drawn again that it records, and checks that its sources are the same as in the recorded run.
+    Returns True if its PDFs have been produced.
+    """
+    sheet = Manifest.sheet_config(config, entry)
+    workdir, outdir = os.path.join("tmp", entry["dir"]), os.path.join("pdf", entry["dir"])
+    sources, _ = generate_student_sheet(filename, sheet, workdir, outdir)
+    digests = {part: hashlib.sha256(source.encode("utf8")).hexdigest()
+               for part, source in zip(("question", "correction"), sources)}
+    if digests == entry["tex"]:
+        print(f"The sources of {entry['student']} (seed {entry['seed']}) are the same as in the recorded run.")
+    else:
+        print(f"The sources of {entry['student']} (seed {entry['seed']}) differ from the recorded run.")
+    with config.metrics.phase("compilation"):
+        return compile_latex(filename, workdir, outdir, formats, cache, metrics=config.metrics, scratch=scratch)
+
+
+def generate_cohort(filename, config, students, jobs=None, formats=None, cache=None, manifest=None, resume=False,
+                    retries=RETRIES, report=None, scratch=None):
+    """
+    Generates one distinct sheet per student, each in its own working directory tmp/<student>/,
+    and compiles them with at most `jobs` concurrent latexmk processes, while the next sheets are generated.
+    The PDFs are gathered in pdf/<student>/.
+    Sheet number i is generated with seed config.seed+i.
+    Each compiled sheet is recorded in the manifest, if any, and the uniqueness index is saved.
+    With resume, the sheets that the manifest records as done with the same parameters are skipped
+    (their questions are only added to the index again). The exercices causing LaTeX errors or overfull boxes
+    are drawn again, up to `retries` per sheet, and reported in report (see compile_checked_async()).
+    Returns the list of students whose sheet failed to compile.
+    """
+    import asyncio
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    dirnames = student_dirnames(students)
+
+    async def compile_sheet(i, sheet, d, sources, lines, slots):
+        outdir = os.path.join("pdf", d)
+        ok, sheet, redrawn = await compile_checked_async(filename, sheet, os.path.join("tmp", d), outdir, slots,
+                                                         formats, cache, retries, report, scratch, lines)
+        sources = redrawn or sources
+        if manifest is not None:
+            manifest.record(i, sheet, d, sources, ok, sheet_pdfs(filename, outdir))
+        if ok and config.index is not None and config.index.path is not None:
+            config.index.save()  # so that the questions handed out are not lost if the run is interrupted
+        return i, ok
+
+    async def pipeline():
+        # The sheets are generated one after the other in a worker thread, and each one starts compiling
+        # as soon as it is written, while the next one is being generated.
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(jobs)
+        compilations = []
+        for i, (name, d) in enumerate(zip(students, dirnames)):
+            sheet = config.replace(seed=config.seed + i, student=name)
+            entry = manifest.entries.get(i) if resume else None
+            if (entry is not None and (entry["student"], entry["seed"]) == (name, sheet.seed)
+                    and Manifest.reproducible(entry)):
+                # the sheet as recorded, so that the PDFs already handed out stay the same
+                sheet = Manifest.sheet_config(sheet, entry, config.index)
+            elif config.index is not None:
+                sheet.index = SheetDraws(config.index)  # recorded in the manifest, to imagine the sheet again
+            if resume and manifest.done(i, sheet, sheet_pdfs(filename, os.path.join("pdf", d))):
+                skipped.append(name)
+                if isinstance(sheet.index, SheetDraws) and sheet.index.rejections:
+                    # puts its questions back in the index, if an interrupted run could not save them
+                    imagine_exercices(sheet.replace(metrics=NO_METRICS), random.Random(sheet.seed))
+                continue
+            t0 = time.perf_counter()
+            sources, lines = await loop.run_in_executor(None, config.metrics.run, generate_student_sheet, filename,
+                                                        sheet, os.path.join("tmp", d), os.path.join("pdf", d))
+            timings["generation"] += time.perf_counter() - t0
+            compilations.append(asyncio.create_task(compile_sheet(i, sheet, d, sources, lines, slots)))
+        return dict(await asyncio.gather(*compilations))
+
+    timings = {"generation": 0.0}
+    skipped = []
+    t0 = time.perf_counter()
+    compiled = asyncio.run(pipeline())
+    timings["total"] = time.perf_counter() - t0
+    failed = [name for i, name in enumerate(students) if not compiled.get(i, True)]
+
+    print(f"Generated {len(students) - len(skipped)} sheets with {jobs} parallel latexmk jobs "
+          f"(seeds {config.seed} to {config.seed+len(students)-1}).")
+    if skipped:
+        print(f"\t{len(skipped)} sheets were already done, according to {manifest.path}.")
+    print(f"\t{'generation':<12} {timings['generation']:8.2f} s")
+    print(f"\t{'compilation':<12} {timings['total'] - timings['generation']:8.2f} s (not overlapped with the generation)")
+    print(f"\t{'total':<12} {timings['total']:8.2f} s")
+    if failed:
+        print(f"Failed to compile the sheets of: {', '.join(failed)}")
+    return failed
+
+
+def read_page_counts(aux_path, n):
+    """
+    Reads the number of pages of each of the n sheets of a merged document, from the labels opensye-end-<i>
+    recorded in its .aux file (the page numbers start again from 1 with each sheet).
+    Returns None if a label is missing.
+    """
+    with open(aux_path, errors="replace") as aux:
+        labels = dict(re.findall(r"\\newlabel\{opensye-end-(\d+)\}\{\{(?:[^{}]|\{[^{}]*\})*\}\{(\d+)\}", aux.read()))
+    try:
+        return [int(labels[str(i)]) for i in range(n)]
+    except KeyError:
+        return None
+
+
+def split_pdf(path, page_counts, outputs):
+    """
+    Splits a PDF into consecutive parts of page_counts pages, written to the outputs paths.
+    Requires pypdf.
+    """
+    try:
+        from pypdf import PdfReader, PdfWriter
+    except ImportError:
+        raise ImportError("split_pdf() requires pypdf (pip install pypdf)") from None
+
+    reader = PdfReader(path)
+    if sum(page_counts) != len(reader.pages):
+        raise ValueError(f"{path} has {len(reader.pages)} pages, but its sheets have {sum(page_counts)} pages")
+    start = 0
+    for count, output in zip(page_counts, outputs):
+        writer = PdfWriter()
+        for page in reader.pages[start:start+count]:
+            writer.add_page(page)
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "wb") as pdf:
+            writer.write(pdf)
+        start += count
+
+
+def generate_merged_cohort(filename, config, students, formats=None, scratch=None):
+    """
+    Same as generate_cohort(), but the questions of all the sheets are merged in a single document,
+    and so are the corrections, so that LaTeX only runs twice for the whole cohort.
+    The merged PDFs are then split into pdf/<student>/, using the number of pages of each sheet.
+    Without pypdf, the merged PDFs are left in pdf/ with the page ranges of the sheets.
+    Returns the list of students whose sheet could not be produced.
+    """
+    dirnames = student_dirnames(students)
+    merged = filename.replace(".tex", "_cohort.tex")
+    timings = {}
+
+    t0 = time.perf_counter()
+    with config.metrics.phase("generation"):
+        question = [latex_merged_header(config)]
+        correction = [latex_merged_header(config, correction=True)]
+        for i, name in enumerate(students):
+            sheet = config.replace(seed=config.seed + i, student=name)
+            q, c = build_sections(sheet)
+            question.append(latex_merged_sheet(sheet, q, i))
+            correction.append(latex_merged_sheet(sheet, c, i, correction=True))
+        os.makedirs("tmp", exist_ok=True)
+        for path, parts in ((merged, question), (merged.replace(".tex", "_corr.tex"), correction)):
+            write_atomic(os.path.join("tmp", path), "".join(parts) + latex_footer())
+    timings["generation"] = time.perf_counter() - t0
+
+    # No PDF cache: the page counts come from the .aux files, that only a real compilation writes
+    t0 = time.perf_counter()
+    with config.metrics.phase("compilation"):
+        compiled = compile_latex(merged, "tmp", "pdf", formats, metrics=config.metrics, scratch=scratch)
+    timings["compilation"] = time.perf_counter() - t0
+    if not compiled:
+        print("Failed to compile the merged sheets.")
+        return list(students)
+
+    t0 = time.perf_counter()
+    failed = []
+    ranges = {}
+    missing = None
+    for part in (merged, merged.replace(".tex", "_corr.tex")):
+        counts = read_page_counts(os.path.join("tmp", part.replace(".tex", ".aux")), len(students))
+        if counts is None:
+            print(f"Could not read the number of pages of each sheet in tmp/{part.replace('.tex', '.aux')}.")
+            return list(students)
+        starts = [1 + sum(counts[:i]) for i in range(len(counts))]
+        ranges[part.replace(".tex", ".pdf")] = {d: [start, start + count - 1] for d, start, count in zip(dirnames, starts, counts)}
+        outputs = [os.path.join("pdf", d, filename.replace(".tex", ".pdf" if part == merged else "_corr.pdf")) for d in dirnames]
+        try:
+            with config.metrics.phase("split"):
+                split_pdf(os.path.join("pdf", part.replace(".tex", ".pdf")), counts, outputs)
+        except ImportError as e:
+            missing = e
+        except ValueError as e:
+            print(e)
+            failed = list(students)
+    with open(os.path.join("pdf", merged.replace(".tex", "_pages.json")), "w") as pages:
+        json.dump(ranges, pages, indent=1)
+    timings["split"] = time.perf_counter() - t0
+    if missing is not None:
+        print(f"{missing}: the merged PDFs are left in pdf/, with the pages of each sheet in "
+              f"pdf/{merged.replace('.tex', '_pages.json')}.")
+
+    print(f"Generated {len(students)} sheets in one merged document (seeds {config.seed} to {config.seed+len(students)-1}).")
+    for phase, seconds in timings.items():
+        print(f"\t{phase:<12} {seconds:8.2f} s")
+    return failed
+
+
+def percentile(values, q):
+    """
+    Returns the q-th percentile (nearest rank) of a list of numbers, or 0 if it is empty.
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values)-1, int(q / 100 * len(values)))]
+
+
+class SheetService:
+    """
+    Renders sheets on demand for the --serve mode.
+    Recent PDFs are kept in memory (and on disk through the PdfCache), identical requests arriving
+    while a sheet is being compiled wait for the same compilation, and at most `jobs` sheets are
+    compiled at once, the other requests waiting in a queue.
+    """
+
+    def __init__(self, base_config, jobs, formats=None, cache=None, memory_size=64):
+        if base_config.index is not None:
+            raise ValueError("SheetService renders a sheet again for each request, which a UniquenessIndex would change")
+        self.base_config = base_config
+        self.formats = formats
+        self.cache = cache
+        self.memory = collections.OrderedDict()
+        self.memory_size = memory_size
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(jobs)
+        self.waiting = 0
+        self.running = 0
+        self.requests = 0
+        self.memory_hits = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.latencies = collections.deque(maxlen=1000)
+
+    def render(self, seed, lang, l33t, exercices, n_exercices):
+        """
+        Returns the (question, correction) PDFs of a sheet.
+        """
+        import concurrent.futures
+        t0 = time.perf_counter()
+        key = (seed, lang, l33t, tuple(exercices), n_exercices)
+        with self.lock:
+            self.requests += 1
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                self.latencies.append(time.perf_counter() - t0)
+                return self.memory[key]
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self.inflight[key] = future
+            else:
+                self.coalesced += 1
+
+        if owner:
+            config = self.base_config.replace(seed=seed, lang=lang, l33t=l33t, exercices=list(exercices),
+                                              n_exercices=n_exercices)
+            try:
+                pdfs = self.compile(config)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(pdfs)
+                with self.lock:
+                    self.memory[key] = pdfs
+                    if len(self.memory) > self.memory_size:
+                        self.memory.popitem(last=False)
+            finally:
+                with self.lock:
+                    del self.inflight[key]
+
+        try:
+            return future.result()
+        except Exception:
+            with self.lock:
+                self.errors += 1
+            raise
+        finally:
+            with self.lock:
+                self.latencies.append(time.perf_counter() - t0)
+
+    def compile(self, config):
+        """
+        Compiles a sheet as soon as a compilation slot is free.
+        """
+        with self.lock:
+            self.waiting += 1
+        with self.slots:
+            with self.lock:
+                self.waiting -= 1
+                self.running += 1
+            try:
+                return config.metrics.run(generate_sheet, config, self.formats, self.cache)
+            finally:
+                with self.lock:
+                    self.running -= 1
+
+    def stats(self):
+        """
+        Returns the queue and cache counters and the latency percentiles (in ms) of the last requests.
+        """
+        with self.lock:
+            latencies = list(self.latencies)
+            stats = {
+                "queue_depth": self.waiting,
+                "running": self.running,
+                "in_flight": len(self.inflight),
+                "requests": self.requests,
+                "memory_hits": self.memory_hits,
+                "memory_entries": len(self.memory),
+                "coalesced": self.coalesced,
+                "errors": self.errors,
+            }
+        if self.cache is not None:
+            stats["pdf_cache_hits"] = self.cache.hits
+            stats["pdf_cache_misses"] = self.cache.misses
+        for q in (50, 90, 99):
+            stats[f"latency_p{q}_ms"] = round(1000 * percentile(latencies, q), 1)
+        return stats
+
+
+def serve(base_config, port, jobs=None, formats=None, cache=None):
+    """
+    Runs the sheet rendering server on localhost until it is interrupted.
+    """
+    import http.server
+    import urllib.parse
+
+    class SheetRequestHandler(http.server.BaseHTTPRequestHandler):
+        """
+        Answers GET /sheet?seed=<int>[&lang=FR|EN][&l33t=<int>][&exercices=states,trees][&n=<int>][&correction=1]
+        with the PDF of the sheet, and GET /stats with the SheetService counters in JSON.
+        """
+
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            service = self.server.service
+            if url.path == "/stats":
+                self.reply(200, "application/json", json.dumps(service.stats()).encode("utf8"))
+                return
+            if url.path != "/sheet":
+                self.reply(404, "text/plain", b"Unknown path, use /sheet or /stats\n")
+                return
+
+            params = urllib.parse.parse_qs(url.query)
+            base = service.base_config
+            try:
+                seed = int(params["seed"][0])
+                lang = params.get("lang", [base.lang])[0]
+                l33t = int(params.get("l33t", [base.l33t])[0])
+                exercices = params.get("exercices", [",".join(base.exercices)])[0].split(",")
+                n_exercices = int(params.get("n", [base.n_exercices])[0])
+                correction = params.get("correction", ["0"])[0] not in ("0", "")
+                if (lang not in ("FR", "EN") or l33t < 0 or n_exercices < 1
+                        or any(e not in EXERCICES for e in exercices)):
+                    raise ValueError
+            except (KeyError, ValueError):
+                self.reply(400, "text/plain", b"Bad request, expected /sheet?seed=<int>[&lang=FR|EN][&l33t=<int>]"
+                           b"[&exercices=states,trees][&n=<int>][&correction=1], with l33t >= 0 and n >= 1\n")
+                return
+
+            try:
+                pdfs = service.render(seed, lang, l33t, exercices, n_exercices)
+            except CompilationError as e:
+                self.reply(500, "text/plain", f"{e}\n".encode("utf8"))
+                return
+            except Exception as e:
+                self.log_error("Could not render %s: %r", self.path, e)
+                self.reply(500, "text/plain", f"Could not render the sheet: {e!r}\n".encode("utf8"))
+                return
+            self.reply(200, "application/pdf", pdfs[1] if correction else pdfs[0])
+
+        def reply(self, code, content_type, body):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), SheetRequestHandler)
+    server.service = SheetService(base_config, jobs or os.cpu_count() or 1, formats, cache)
+    print(f"Serving sheets on http://127.0.0.1:{port}/sheet?seed=<int> (statistics on /stats)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+VERDICTS = {"possible": True, "impossible": False, "yes": True, "no": False, "oui": True, "non": False,
+            "true": True, "false": False, "1": True, "0": False, "correct": True, "wrong": False,
+            "v": True, "f": False, "vrai": True, "faux": False}
+
+
+def read_submissions(path):
+    """
+    Reads student answers from a CSV file (with a header line) or a JSON Lines file (.jsonl).
+    Each answer has the fields student, seed, exercice (a key of EXERCICES), question (its number in the
+    exercice, as printed on the sheet) and answer.
+    """
+    import csv
+
+    with open(path, newline="") as f:
+        if path.endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return list(csv.DictReader(f))
 
 
+def grade_answer(exo, question, answer):
+    """
+    Tells if an answer to a question of an imagined exercice is right.
+    For ProcessStateExercice, the answer is a verdict (possible/impossible, yes/no...).
+    For RunningTreeExercice, it is the composition in the other notation, compared to the expected one
+    up to the order of parallel tasks and to superfluous brackets.
+    Questions are numbered from 1: a question which is not on the sheet is wrong.
+    """
+    if question < 1:
+        return False
+    if isinstance(exo, ProcessStateExercice):
+        verdict = VERDICTS.get(answer.strip().lower())
+        return verdict is not None and verdict == exo.corrections[question-1]
+    if question <= len(exo.trees):
+        expected = exo.trees[question-1]
+    else:
+        expected = exo.rev_trees[question-len(exo.trees)-1]
+    try:
+        return parse_composition(answer).canonical() == expected.canonical()
+    except ValueError:
+        return False
+
+
+def grade_seed(config, seed, submissions, entry=None):
+    """
+    Imagines again the sheet generated with a seed, and grades the answers given to it.
+    If the sheet is recorded in a manifest, entry is its line: the sheet is imagined with the parameters
+    and the exercices drawn again that it records, instead of the ones of config.
+    Returns a list of (student, right) pairs.
+    """
+    config = config.replace(index=None) if entry is None else Manifest.sheet_config(config, entry)
+    exercices = imagine_exercices(config.replace(seed=seed), random.Random(seed))
+    by_name = {EXERCICES.name_of(type(exo)): exo for exo in exercices}
+    results = []
+    for sub in submissions:
+        exo = by_name.get(sub["exercice"])
+        try:
+            right = exo is not None and grade_answer(exo, int(sub["question"]), str(sub["answer"]))
+        except (IndexError, ValueError):
+            right = False  # a question which is not on this sheet
+        results.append((sub["student"], right))
+    return results
+
+
+def grade_submissions(path, config, output, jobs=None, entries=None):
+    """
+    Grades all the answers of a submission file, in parallel over the sheets, and writes
+    the score of each student to the CSV file output.
+    entries gives the Manifest lines of the sheets by seed: these sheets are imagined with the parameters
+    they record, the other ones with config.
+    """
+    entries = {} if entries is None else entries
+    import concurrent.futures
+    t0 = time.perf_counter()
+    by_seed = collections.defaultdict(list)
+    for sub in read_submissions(path):
+        by_seed[int(sub["seed"])].append(sub)
+    refused = [seed for seed in by_seed if seed in entries and not Manifest.reproducible(entries[seed])]
+    if refused:
+        print(f"The answers to the sheets of seeds {', '.join(map(str, sorted(refused)))} are not graded: they used "
+              "a uniqueness index, and the manifest does not record their draws.")
+        for seed in refused:
+            del by_seed[seed]
+
+    scores = collections.OrderedDict()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        seeds = list(by_seed)
+        for results in pool.map(grade_seed, [config]*len(seeds), seeds, [by_seed[seed] for seed in seeds],
+                                [entries.get(seed) for seed in seeds],
+                                chunksize=max(1, len(seeds) // (4 * (jobs or os.cpu_count() or 1)))):
+            for student, right in results:
+                total, n = scores.get(student, (0, 0))
+                scores[student] = (total + int(right), n + 1)
+
+    import csv
+
+    with open(output, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["student", "right", "answers", "score"])
+        for student, (right, n) in scores.items():
+            writer.writerow([student, right, n, f"{right / n:.3f}"])
+    n_answers = sum(n for _, n in scores.values())
+    print(f"Graded {n_answers} answers of {len(scores)} students in {time.perf_counter() - t0:.2f} s, scores written to {output}.")
+    recorded = sum(seed in entries for seed in seeds)
+    if recorded < len(seeds):
+        print(f"\t{len(seeds) - recorded} of the {len(seeds)} sheets are not in the manifest, "
+              "they were imagined with the options of the command line.")
+
+
+# Matches the parts of a LaTeX string that must not be translated to l33t: verbatim blocks, environment names,
+# math and control sequences. Everything between two matches is plain text.
+LATEX_TOKENS = re.compile(r"""
+      \\begin\{verbatim\}.*?\\end\{verbatim\}
+    | \\(?:begin|end)\{[^}]*\}
+    | \$\$.*?\$\$ | \$[^$]*\$ | \\\(.*?\\\) | \\\[.*?\\\]
+    | \\[A-Za-z@]+\*?
+    | \\.
+    """, re.DOTALL | re.VERBOSE)
+
+
+@functools.lru_cache(maxsize=4096)
 def to_l33t(string, level):
+    """
+    Translates the text of a LaTeX string to l33t-5p34k, in a single pass.
+    Control sequences, environment names, math and verbatim blocks are kept as they are.
+    Levels above 3 are translated as level 3. Results are memoized, as the same guidelines are
+    translated again for every sheet.
+    """
     if not level:
         return string
-    string = string.lower()
-    if level == 1:
-        string = "".join(
-            [leet_level_1[c] if c in leet_level_1.keys() else c for c in string])
-    elif level == 2:
-        string = "".join(
-            [leet_level_2[c] if c in leet_level_2.keys() else c for c in string])
-    else:
-        string = "".join(
-            [leet_level_3[c] if c in leet_level_3.keys() else c for c in string])
-    if len(string) > 30:
-        for word in ["section", "begin", "end", "textbf", "textit", "verbatim", "rightarrow"]:
-            string = string.replace(to_l33t(word, level), word)
-    return string
+    table = leet_tables[min(level, 3)]
+    out = []
+    pos = 0
+    for token in LATEX_TOKENS.finditer(string):
+        out.append(string[pos:token.start()].lower().translate(table))
+        out.append(token.group())
+        pos = token.end()
+    out.append(string[pos:].lower().translate(table))
+    return "".join(out)
 
 
 if __name__ == "__main__":
     try:
         opts, _ = getopt.getopt(sys.argv[1:], "hl:n:", [
-                                "year=", "help", "lang=", "l33t", "title="])
+                                "year=", "difficulty=", "exercices=", "help", "lang=", "l33t", "title=",
+                                "students=", "roster=", "seed=", "jobs=",
+                                "merged", "resume", "replay=", "retries=", "cache-dir=", "no-format", "full-preamble", "pdf-cache-size=",
+                                "scratch=", "no-scratch", "keep-scratch", "scratch-quota=",
+                                "serve", "port=", "grade=", "grades-output=", "unique=",
+                                "metrics=", "profile=", "format="])
     except getopt.GetoptError as err:
         print(err)
         sys.exit(2)
@@ -567,12 +3224,49 @@ if __name__ == "__main__":
                 "-l, --lang [FR, EN] \tChanges the exercice's output language.")
             print("--l33t\t\t\tTranslates the exercices to l33t-5p34k, to facilitate\n\t\t\t understanding with the students. Using the option\n\t\t\t several times increases the l33t level.")
             print("--title <arg>\t\tTitle of the exam sheet.")
+            print("--exercices <list>\tExercices to pick from, with optional weights (like states:2,trees),\n\t\t\t among the built-in ones and the plugins (defaults to all, with weight 1).")
+            print("--difficulty <arg>\tSize of the questions: easy, medium (by default) or hard.")
             print("--year <arg>\t\tPredicts the TD exercices that will be published\n\t\t\t in scholar year <arg/arg+1> ")
+            print("--seed <arg>\t\tSeed of the random generator, to reproduce a sheet.")
+            print("--students <N>\t\tGenerates N distinct sheets, one per student, in pdf/<student>/.")
+            print("--roster <file>\t\tSame, with the student names read from a file (one per line).")
+            print("--jobs <N>\t\tMaximum number of parallel latexmk processes\n\t\t\t (defaults to the number of cores).")
+            print("--merged\t\tWith --students or --roster, compiles all the sheets in one LaTeX document,\n\t\t\t then splits it per student (requires pypdf).")
+            print("--resume\t\tResumes an interrupted --students or --roster run: skips the sheets that\n\t\t\t pdf/<file>_manifest.jsonl records as done (with the same options).")
+            print("--replay <student>\tGenerates again the sheet of a student (or sheet number) recorded in\n\t\t\t pdf/<file>_manifest.jsonl, and checks that it is the same.")
+            print(f"--retries <N>\t\tExercices drawn again per sheet when they cause LaTeX errors or overfull\n\t\t\t boxes (defaults to {RETRIES}, 0 only reports them).")
+            print("--cache-dir <dir>\tWhere to keep the precompiled LaTeX formats\n\t\t\t (defaults to ~/.cache/opensye).")
+            print("--no-format\t\tDo not precompile the LaTeX preamble into a format.")
+            print("--full-preamble\t\tLoad all the LaTeX packages, not only the ones used by the exercices.")
+            print("--pdf-cache-size <MB>\tSize of the cache of compiled PDFs (defaults to 200 MB,\n\t\t\t 0 disables the cache).")
+            print(f"--scratch <dir>\t\tWhere latexmk runs, in one private folder per compilation\n\t\t\t (defaults to {SCRATCH_DIR or tempfile.gettempdir()}).")
+            print("--no-scratch\t\tRuns latexmk directly in tmp/, like before.")
+            print("--keep-scratch\t\tKeeps all the scratch folders, not only the ones of the failed compilations.")
+            print(f"--scratch-quota <MB>\tFree space needed in the scratch folder, and maximum size of the kept\n\t\t\t folders (defaults to {SCRATCH_QUOTA} MB).")
+            print("--serve\t\t\tRuns a local HTTP server rendering the sheets on demand.")
+            print("--port <N>\t\tPort of the server (defaults to 8000).")
+            print("--grade <file>\t\tGrades the student answers of a CSV or JSONL file.")
+            print("--grades-output <file>\tWhere to write the scores (defaults to grades.csv).")
+            print("--unique <file>\t\tNever hands out twice the same question, across all the runs\n\t\t\t using this index file.")
+            print("--metrics <file>\tWrites the time and memory used by each phase, exercice and compilation\n\t\t\t to a JSON file.")
+            print("--profile <file>\tProfiles the run with cProfile, and writes the statistics to <file>.")
+            print("--format <arg>\t\tOutput format: latex (PDFs, by default), html, markdown, json or moodle (XML).\n\t\t\t The other formats than latex do not need LaTeX, and write a single file in out/\n\t\t\t for all the sheets.")
             sys.exit(0)
         if opt == "--year":
             YEAR = int(arg)
         if opt == "-n":
             NEXERCICES = int(arg)
+        if opt == "--exercices":
+            try:
+                EXERCICE_NAMES, EXERCICE_WEIGHTS = parse_exercices(arg)
+            except ValueError as e:
+                print(e)
+                sys.exit(2)
+        if opt == "--difficulty":
+            if arg not in RunningTreeExercice.sizes:
+                print(f"Unknown difficulty {arg}, use one of: {', '.join(RunningTreeExercice.sizes)}.")
+                sys.exit(2)
+            DIFFICULTY = arg
         if opt == "-l" or opt == "--lang":
             if arg in ["FR", "EN"]:
                 LANG = str(arg)
@@ -584,6 +3278,57 @@ if __name__ == "__main__":
         if opt == "--title":
             TITLE_FR = arg
             TITLE_EN = arg
+        if opt == "--seed":
+            SEED = int(arg)
+        if opt == "--students":
+            STUDENTS = [f"student_{i+1:03d}" for i in range(int(arg))]
+        if opt == "--roster":
+            STUDENTS = read_roster(arg)
+        if opt == "--merged":
+            MERGED = True
+        if opt == "--resume":
+            RESUME = True
+        if opt == "--retries":
+            RETRIES = int(arg)
+        if opt == "--replay":
+            REPLAY = arg
+        if opt == "--jobs":
+            JOBS = int(arg)
+        if opt == "--cache-dir":
+            CACHE_DIR = arg
+        if opt == "--no-format":
+            USE_FORMAT = False
+        if opt == "--full-preamble":
+            LEAN = False
+        if opt == "--pdf-cache-size":
+            PDF_CACHE_SIZE = float(arg)
+        if opt == "--scratch":
+            SCRATCH_DIR = arg
+        if opt == "--no-scratch":
+            USE_SCRATCH = False
+        if opt == "--keep-scratch":
+            KEEP_SCRATCH = "always"
+        if opt == "--scratch-quota":
+            SCRATCH_QUOTA = float(arg)
+        if opt == "--serve":
+            SERVE = True
+        if opt == "--port":
+            PORT = int(arg)
+        if opt == "--grade":
+            GRADE = arg
+        if opt == "--grades-output":
+            GRADES_OUTPUT = arg
+        if opt == "--unique":
+            UNIQUE = arg
+        if opt == "--metrics":
+            METRICS = arg
+        if opt == "--format":
+            if arg != "latex" and arg not in RENDERERS:
+                print(f"Unknown format {arg}, use one of: latex, {', '.join(RENDERERS)}.")
+                sys.exit(2)
+            FORMAT = arg
+        if opt == "--profile":
+            PROFILE = arg
 
     if L33TLVL == 0:
         print("OpenSYE Pro Plus Max 11 SE - Welcome")
@@ -599,23 +3344,143 @@ if __name__ == "__main__":
         if L33TLVL:
             print(
                 to_l33t(f"Translating them to level {L33TLVL} l33t-5p34k.", L33TLVL))
-    os.makedirs("tmp", exist_ok=True)
-    os.makedirs("pdf", exist_ok=True)
-    subprocess.run(["rm", '-f', "tmp/"+FILENAME])
-    subprocess.run(["rm", '-f', "tmp/"+FILENAME.replace(".tex", "_corr.tex")])
-    subprocess.run(["rm", '-f', "pdf/"+FILENAME.replace(".tex", ".pdf")])
-    subprocess.run(["rm", '-f', "pdf/"+FILENAME.replace(".tex", "_corr.pdf")])
-
-    if LANG == "FR":
-        generate_latex_header(FILENAME, to_l33t(TITLE_FR, L33TLVL))
-    elif LANG == "EN":
-        generate_latex_header(FILENAME, to_l33t(TITLE_EN, L33TLVL))
-
-    exercices = [ProcessStateExercice(), RunningTreeExercice()]
-    random.shuffle(exercices)
-    for i in range(NEXERCICES):
-        exercices[i].imagine()
-        generate_exercice(FILENAME, exercices[i])
-
-    generate_latex_footer(FILENAME)
-    compile_latex(FILENAME)
+    manifest = None
+    manifest_path = os.path.join("pdf", FILENAME.replace(".tex", "_manifest.jsonl"))
+    if RESUME or REPLAY is not None:
+        manifest = Manifest(manifest_path)
+        if not manifest.entries:
+            print(f"Nothing to {'resume' if RESUME else 'replay'}, {manifest_path} records no sheet.")
+            sys.exit(2)
+    if RESUME and MERGED:
+        print("--resume does not apply to --merged runs, which compile all the sheets at once.")
+        sys.exit(2)
+    if UNIQUE is not None and SERVE:
+        print("--unique does not apply to --serve: a sheet rendered again would not be the one handed out,"
+              " as the index then holds its questions.")
+        sys.exit(2)
+    if RESUME:
+        # By default, resume the same students with the same seeds
+        first = manifest.entries[min(manifest.entries)]
+        if not STUDENTS:
+            STUDENTS = [entry["student"] for _, entry in sorted(manifest.entries.items())]
+        if SEED is None:
+            SEED = first["seed"] - first["index"]
+    if REPLAY is not None:
+        entry = manifest.find(REPLAY)
+        if entry is None:
+            print(f"No sheet of {REPLAY} in {manifest_path}.")
+            sys.exit(2)
+        if not Manifest.reproducible(entry):
+            print(f"The sheet of {entry['student']} used a uniqueness index, but {manifest_path} does not record "
+                  "its draws: it cannot be generated again.")
+            sys.exit(2)
+        SEED = entry["seed"]
+    if SEED is None:
+        SEED = random.randrange(2**32)
+    metrics = NO_METRICS
+    if METRICS is not None:
+        metrics = Metrics(METRICS)
+        atexit.register(metrics.save)
+    if PROFILE is not None:
+        import cProfile
+        import pstats
+
+        if metrics is NO_METRICS:
+            metrics = Metrics(enabled=False)  # only to profile the worker threads
+        metrics.profile = pstats.Stats()
+        profiler = cProfile.Profile()
+        atexit.register(metrics.save_profile, profiler, PROFILE)
+        profiler.enable()
+
+    config = SheetConfig(LANG, L33TLVL, YEAR, SEED, exercices=EXERCICE_NAMES, n_exercices=NEXERCICES,
+                         title=TITLE_FR if LANG == "FR" else TITLE_EN, lean=LEAN, metrics=metrics,
+                         difficulty=DIFFICULTY, weights=EXERCICE_WEIGHTS)
+    if RESUME:
+        # The options of the recorded run, unless the command line gives other ones
+        given = {opt for opt, _ in opts}
+        options = {"lang": ("-l", "--lang"), "l33t": ("--l33t",), "year": ("--year",), "title": ("--title",),
+                   "exercices": ("--exercices",), "weights": ("--exercices",), "n_exercices": ("-n",),
+                   "difficulty": ("--difficulty",), "lean": ("--full-preamble",)}
+        changed = [field for field, names in options.items()
+                   if given.intersection(names) and getattr(config, field) != first[field]]
+        if changed:
+            print(f"Cannot resume with other options than the recorded run ({', '.join(changed)}), "
+                  f"remove them or start a new run without --resume.")
+            sys.exit(2)
+        config = config.replace(**{field: first[field] for field in Manifest.fields if field not in ("student", "seed")})
+    print(f"Seed: {SEED} (use --seed {SEED} to generate this sheet again)")
+    if UNIQUE is not None and GRADE is None and REPLAY is None:
+        config.index = UniquenessIndex(UNIQUE)
+
+    if GRADE is not None:
+        entries = None
+        if os.path.isfile(manifest_path):  # the options and the exercices drawn again of each sheet
+            entries = {entry["seed"]: entry for entry in Manifest(manifest_path).entries.values()}
+        with metrics.phase("grading"):
+            grade_submissions(GRADE, config, GRADES_OUTPUT, JOBS, entries)
+        sys.exit(0)
+
+    if FORMAT != "latex":
+        t0 = time.perf_counter()
+        with metrics.phase("rendering"):
+            paths = render_sheets(FILENAME, config, STUDENTS, FORMAT)
+        print(f"Rendered {max(len(STUDENTS), 1)} sheets to {', '.join(paths)} in {time.perf_counter() - t0:.2f} s.")
+        if config.index is not None:
+            config.index.save()
+            config.index.report()
+        sys.exit(0)
+
+    with metrics.phase("setup"):
+        formats = None
+        if USE_FORMAT:
+            formats = os.path.join(CACHE_DIR, "formats")
+            if preamble_format(latex_preamble(sheet_packages(config)), formats) is None:
+                print("Could not precompile the LaTeX preamble (is mylatexformat installed ?), compiling without format.")
+                formats = None
+
+        cache = None
+        if PDF_CACHE_SIZE > 0:
+            cache = PdfCache(os.path.join(CACHE_DIR, "pdf"), int(PDF_CACHE_SIZE * 1024 * 1024))
+
+        scratch = None
+        if USE_SCRATCH:
+            if SCRATCH_DIR is not None:
+                os.makedirs(SCRATCH_DIR, exist_ok=True)
+            scratch = Workspaces(SCRATCH_DIR, int(SCRATCH_QUOTA * 1024 * 1024), KEEP_SCRATCH)
+
+    failed = []
+    layout = []
+    if SERVE:
+        serve(config, PORT, JOBS, formats, cache)
+    elif REPLAY is not None:
+        failed = [] if replay_sheet(FILENAME, config, entry, formats, cache, scratch) else [REPLAY]
+    elif STUDENTS and MERGED:
+        failed = generate_merged_cohort(FILENAME, config, STUDENTS, formats, scratch)
+    elif STUDENTS:
+        with metrics.phase("cohort"):
+            failed = generate_cohort(FILENAME, config, STUDENTS, JOBS, formats, cache,
+                                     Manifest(manifest_path, load=RESUME), RESUME, RETRIES, layout, scratch)
+    else:
+        with metrics.phase("generation"):
+            clean_outputs(FILENAME)
+            # its own draws from the index, so that the exercices kept by a redraw are imagined the same
+            sheet = config if config.index is None else config.replace(index=SheetDraws(config.index))
+            _, lines = generate_sheet_files(FILENAME, sheet)
+        with config.metrics.phase("compilation"):
+            compiled, _, _ = compile_checked(FILENAME, sheet, formats=formats, cache=cache, jobs=JOBS or 2,
+                                             retries=RETRIES, report=layout, scratch=scratch, lines=lines)
+        failed = [] if compiled else [FILENAME]
+    report_layout(layout, os.path.join("pdf", FILENAME.replace(".tex", "_layout.json")))
+
+    if cache is not None:
+        cache.report()
+    if scratch is not None and scratch.compilations:
+        scratch.report()
+    if config.lean and not SERVE:
+        compilations = 2 * (len(STUDENTS) if STUDENTS and not MERGED and REPLAY is None else 1) - (cache.hits if cache is not None else 0)
+        with metrics.phase("preamble measure"):
+            report_lean_preamble(sheet_packages(config), compilations, CACHE_DIR, formats)
+    if config.index is not None:
+        config.index.save()
+        config.index.report()
+    sys.exit(1 if failed else 0)